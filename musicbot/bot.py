@@ -30,7 +30,7 @@ from datetime import timedelta
 from random import choice, shuffle
 from collections import defaultdict
 
-from musicbot.playlist import Playlist
+from musicbot.playlist import Playlist, PLAYLIST_CONCURRENCY
 from musicbot.player import MusicPlayer
 from musicbot.config import Config, ConfigDefaults
 from musicbot.permissions import Permissions, PermissionsDefaults
@@ -38,9 +38,15 @@ from musicbot.utils import load_file, write_file, sane_round_int
 
 from . import exceptions
 from . import downloader
+from .cache import CacheManager
+from .decoders import DecoderPool
+from .loudness import LoudnessAnalyzer
+from .monitor import LoopMonitor
+from .opus import OpusCache
 from .opus_loader import load_opus_lib
+from .snapshots import QueueSnapshots
 from .constants import VERSION as BOTVERSION
-from .constants import DISCORD_MSG_CHAR_LIMIT, AUDIO_CACHE_PATH
+from .constants import DISCORD_MSG_CHAR_LIMIT, AUDIO_CACHE_PATH, QUEUE_SNAPSHOT_PATH
 
 
 
@@ -89,7 +95,31 @@ class MusicBot(discord.Client):
 
         self.blacklist = set(load_file(self.config.blacklist_file))
         self.autoplaylist = load_file(self.config.auto_playlist_file)
-        self.downloader = downloader.Downloader(download_folder='audio_cache')
+        self.downloader = downloader.Downloader(
+            download_folder='audio_cache',
+            cache_ttl=self.config.metadata_cache_ttl,
+            cache_size=self.config.metadata_cache_size * 1024 * 1024,
+            processes=self.config.extractor_processes)
+        self.cache_manager = CacheManager(
+            self.downloader.cache_index,
+            budget=self.config.cache_budget * 1024 * 1024,
+            policy=self.config.cache_policy,
+            pinned=self._pinned_cache_files,
+            autoplaylist=self.autoplaylist)
+
+        self.decoder_pool = DecoderPool(per_player=self.config.spare_decoders)
+
+        self.loudness = None
+        if self.config.normalize_loudness:
+            self.loudness = LoudnessAnalyzer(target=self.config.loudness_target)
+
+        self.opus_cache = None
+        if self.config.opus_cache:
+            self.opus_cache = OpusCache(self.downloader.fs, gain=self.config.default_volume)
+            self.cache_manager.on_evict = lambda path: self.opus_cache.discard(path, self.track_gain(path))
+
+        # Queues are always saved when the bot shuts down, the interval only adds saving them in between.
+        self.queue_snapshots = QueueSnapshots(self, QUEUE_SNAPSHOT_PATH, interval=self.config.queue_snapshot_interval)
 
         self.exit_signal = None
         self.init_ok = False
@@ -105,6 +135,7 @@ class MusicBot(discord.Client):
 
         super().__init__()
         self.aiosession = aiohttp.ClientSession(loop=self.loop)
+        self.loop_monitor = LoopMonitor(self.loop)
         self.http.user_agent += ' MusicBot/%s' % BOTVERSION
 
     # TODO: Add some sort of `denied` argument for a message to send when someone else tries to use it
@@ -135,6 +166,51 @@ class MusicBot(discord.Client):
         else:
             return discord.utils.find(lambda m: m.id == self.config.owner_id, self.get_all_members())
 
+    def _pinned_cache_files(self):
+        """
+            The files the cache manager must leave alone: the songs that are playing or queued.
+        """
+        pinned = set()
+
+        for player in self.players.values():
+            entries = list(player.playlist.entries)
+            if player.current_entry:
+                entries.append(player.current_entry)
+
+            for entry in entries:
+                filename = entry.filename or getattr(entry, 'expected_filename', None)
+                if filename:
+                    pinned.add(os.path.basename(filename))
+
+        return pinned
+
+    def track_gain(self, filename):
+        """
+            The gain that evens out the loudness of `filename`, or 1.0 if it hasn't been measured (yet).
+        """
+        if not self.loudness or not filename:
+            return 1.0
+
+        record = self.cache_manager.get(filename)
+        return self.loudness.gain_for(record.get('loudness'), record.get('peak'))
+
+    async def process_download(self, filename):
+        """
+            Runs the optional stages after a song is downloaded (or found in the cache):
+            measuring its loudness and making its opus version.
+        """
+        if self.loudness and 'loudness' not in self.cache_manager.get(filename):
+            result = await self.loudness.analyze(filename) or (None, None)
+            self.cache_manager.update(filename, loudness=result[0], peak=result[1])
+
+            # The song might have started playing in the meantime.
+            for player in self.players.values():
+                if player.current_entry and player.current_entry.filename == filename:
+                    player.update_track_gain()
+
+        if self.opus_cache:
+            await self.opus_cache.transcode(filename, self.track_gain(filename))
+
     def _delete_old_audiocache(self, path=AUDIO_CACHE_PATH):
         try:
             shutil.rmtree(path)
@@ -384,10 +460,17 @@ class MusicBot(discord.Client):
 
         if server.id in self.players:
             self.players.pop(server.id).kill()
+            self.decoder_pool.resize(len(self.players))
 
         await self.the_voice_clients.pop(server.id).disconnect()
 
     async def disconnect_all_voice_clients(self):
+        # This is what we do before a restart or shutting down, remember the queues for when we're back.
+        try:
+            await self.queue_snapshots.save(final=True)
+        except Exception:
+            traceback.print_exc()
+
         for vc in self.the_voice_clients.copy().values():
             await self.disconnect_voice_client(vc.channel.server)
 
@@ -437,6 +520,7 @@ class MusicBot(discord.Client):
 
             player.skip_state = SkipState()
             self.players[server.id] = player
+            self.decoder_pool.resize(len(self.players))
 
         return self.players[server.id]
 
@@ -444,8 +528,12 @@ class MusicBot(discord.Client):
         await self.update_now_playing(entry)
         player.skip_state.reset()
 
-        channel = entry.meta.get('channel', None)
-        author = entry.meta.get('author', None)
+        if entry.filename:
+            self.cache_manager.record_play(entry.url, entry.filename)
+
+        meta = entry.meta
+        channel = meta.get('channel', None)
+        author = meta.get('author', None)
 
         if channel and author:
             last_np_msg = self.server_specific_data[channel.server]['last_np_msg']
@@ -459,7 +547,7 @@ class MusicBot(discord.Client):
 
             if self.config.now_playing_mentions:
                 newmsg = '%s - je nummer **%s** speelt nu in %s!' % (
-                    entry.meta['author'].mention, entry.title, player.voice_client.channel.name)
+                    author.mention, entry.title, player.voice_client.channel.name)
             else:
                 newmsg = 'Speelt nu in %s: **%s**' % (
                     player.voice_client.channel.name, entry.title)
@@ -600,6 +688,14 @@ class MusicBot(discord.Client):
         except: # Can be ignored
             pass
 
+        self.downloader.shutdown()
+        self.decoder_pool.shutdown()
+        if self.opus_cache:
+            self.opus_cache.shutdown()
+        if self.loudness:
+            self.loudness.shutdown()
+        self.cache_manager.save()
+
         pending = asyncio.Task.all_tasks()
         gathered = asyncio.gather(*pending)
 
@@ -612,6 +708,13 @@ class MusicBot(discord.Client):
 
     # noinspection PyMethodOverriding
     def run(self):
+        self.loop.create_task(self.loop_monitor.run())
+
+        self.loop.create_task(self.cache_manager.run())
+
+        if self.config.queue_snapshot_interval:
+            self.loop.create_task(self.queue_snapshots.run())
+
         try:
             self.loop.run_until_complete(self.start(*self.config.auth))
 
@@ -775,18 +878,40 @@ class MusicBot(discord.Client):
         if self.config.delete_messages:
             print("    Delete Invoking: " + ['Disabled', 'Enabled'][self.config.delete_invoking])
         print("  Debug Mode: " + ['Disabled', 'Enabled'][self.config.debug_mode])
-        print("  Downloaded songs will be %s" % ['deleted', 'saved'][self.config.save_videos])
+        if self.cache_manager.enabled:
+            print("  Downloaded songs will be kept up to %s MB (%s)" % (self.config.cache_budget, self.cache_manager.policy))
+        else:
+            print("  Downloaded songs will be %s" % ['deleted', 'saved'][self.config.save_videos])
+        print("  Gapless playback: " + ['Disabled', 'Enabled'][self.config.gapless_playback])
+        print("  Stream mode: " + ['Disabled', 'Enabled'][self.config.stream_mode])
+        print("  Opus cache: " + ['Disabled', 'Enabled'][self.config.opus_cache])
+        if self.decoder_pool.enabled:
+            print("  Spare ffmpeg processes: %s per player" % self.config.spare_decoders)
+        if self.loudness:
+            print("  Loudness normalization: %s LUFS" % self._fixg(self.config.loudness_target, 1))
+        else:
+            print("  Loudness normalization: Disabled")
+        if self.config.queue_snapshot_interval:
+            print("  Queues saved every %s seconds" % self.config.queue_snapshot_interval)
+        else:
+            print("  Queues saved: On shutdown")
+        print("  Metadata cache: " + ['Disabled', 'Enabled'][self.downloader.metadata_cache.enabled])
+        if self.downloader.process_pool:
+            print("  Extractor processes: %s" % self.config.extractor_processes)
         print()
 
         # maybe option to leave the ownerid blank and generate a random command for the owner to use
         # wait_for_message is pretty neato
 
-        if not self.config.save_videos and os.path.isdir(AUDIO_CACHE_PATH):
-            if self._delete_old_audiocache():
+        if not self.config.save_videos and not self.cache_manager.enabled and os.path.isdir(AUDIO_CACHE_PATH):
+            if await self.downloader.fs.run(self._delete_old_audiocache):
+                self.downloader.cache_index.clear()
                 print("Deleting old audio cache")
             else:
                 print("Could not delete old audio cache, moving on.")
 
+        await self.queue_snapshots.restore()
+
         if self.config.autojoin_channels:
             await self._autojoin_channels(autojoin_channels)
 
@@ -880,6 +1005,71 @@ class MusicBot(discord.Client):
             data = await temp.json()
             return data
 
+    async def cmd_stats(self):
+        """
+        Uitleg:
+            ;stats
+
+        Laat statistieken over de caches en de prestaties van de bot zien.
+        """
+
+        cache = self.downloader.metadata_cache
+        lines = []
+
+        if cache.enabled:
+            lookups = cache.hits + cache.misses
+            lines.append("Metadata cache: %s items, %s KB, %s hits / %s misses (%s%%)" % (
+                len(cache), cache.size // 1024, cache.hits, cache.misses,
+                self._fixg(100 * cache.hits / lookups if lookups else 0, 1)))
+        else:
+            lines.append("Metadata cache: uitgeschakeld")
+
+        cache_index = self.downloader.cache_index
+        if self.cache_manager.enabled:
+            lines.append("Audiocache: %s bestanden, %s / %s MB (%s), %s verwijderd" % (
+                len(cache_index), cache_index.size // (1024 * 1024), self.config.cache_budget,
+                self.cache_manager.policy, self.cache_manager.evictions))
+        else:
+            lines.append("Audiocache: %s bestanden, %s MB" % (len(cache_index), cache_index.size // (1024 * 1024)))
+
+        content_store = self.downloader.content_store
+        lines.append("Directe links: %s opgeslagen, %s keer dezelfde audio hergebruikt" % (
+            len(content_store.urls), content_store.deduplicated))
+
+        scheduler = self.downloader.scheduler
+        lines.append("Downloads: %s actief, %s voltooid, %s onderbroken voor belangrijkere downloads" % (
+            scheduler.running, scheduler.completed, scheduler.preempted))
+        lines.append("Downloadwachtrij: " + ', '.join(
+            '%s %s' % (str(priority).lower(), depth) for priority, depth in scheduler.queue_depth().items()))
+
+        lines.append("Extracties: %s uitgevoerd in %s, %s samengevoegd met een lopende extractie" % (
+            self.downloader.extractions,
+            'processen' if self.downloader.process_pool else 'threads',
+            self.downloader.coalesced))
+
+        if self.loudness:
+            lines.append("Luidheid: %s nummers gemeten, %s mislukt, doel %s LUFS" % (
+                self.loudness.analyzed, self.loudness.failed, self._fixg(self.loudness.target, 1)))
+
+        if self.opus_cache:
+            lines.append("Opus cache: %s nummers omgezet, %s mislukt" % (self.opus_cache.transcoded, self.opus_cache.failed))
+
+        pool = self.decoder_pool
+        if pool.enabled:
+            lines.append("ffmpeg: %s klaar voor gebruik, %s gebruikt, %s gestart" % (pool.spare, pool.handed_out, pool.spawned))
+
+        monitor = self.loop_monitor
+        lines.append("Event loop vertraging: gemiddeld %s ms, max %s ms (laatste minuut), ergste %s ms, %s keer vastgelopen" % (
+            self._fixg(monitor.average * 1000, 1), self._fixg(monitor.recent_max * 1000, 1),
+            self._fixg(monitor.worst * 1000, 1), monitor.stalls))
+
+        lines.append("Wachtrijen: %s keer opgeslagen, %s nummers teruggezet na het opstarten" % (
+            self.queue_snapshots.saved, self.queue_snapshots.restored))
+
+        lines.append("Bestandssysteem: %s acties buiten de event loop uitgevoerd" % self.downloader.fs.calls)
+
+        return Response('```\n%s\n```' % '\n'.join(lines), delete_after=30)
+
     async def cmd_uptime(self, channel):
         timeSeconds = (time.time() - startTime)
         m, s = divmod(timeSeconds, 60)
@@ -1036,6 +1226,24 @@ class MusicBot(discord.Client):
         Voegt een nummer toe aan de wachtrij.  Als je geen link invoert wordt het eerste resultaat van YouTube gepakt.
         """
 
+        return await self._cmd_play(player, channel, author, permissions, leftover_args, song_url)
+
+    async def cmd_playnext(self, player, channel, author, permissions, leftover_args, song_url):
+        """
+        Uitleg:
+            ;playnext link
+            ;playnext zoektekst
+
+        Zet een nummer vooraan in de wachtrij, zodat het hierna wordt afgespeeld.  Alleen voor wie ook nummers
+        van anderen mag overslaan.
+        """
+
+        if author.id != self.config.owner_id and not permissions.instaskip:
+            raise exceptions.PermissionsError('Je mag niet voordringen in de wachtrij.', expire_in=20)
+
+        return await self._cmd_play(player, channel, author, permissions, leftover_args, song_url, head=True)
+
+    async def _cmd_play(self, player, channel, author, permissions, leftover_args, song_url, *, head=False):
         song_url = song_url.strip('<>')
         sites = ['dumpert', 'redtube', 'telegraaf']
         for site in sites:
@@ -1095,6 +1303,9 @@ class MusicBot(discord.Client):
         # TODO: Possibly add another check here to see about things like the bandcamp issue
         # TODO: Where ytdl gets the generic extractor version with no processing, but finds two different urls
 
+        if 'entries' in info and head:
+            raise exceptions.CommandError("Afspeellijsten kunnen niet vooraan in de wachtrij worden gezet.", expire_in=30)
+
         if 'entries' in info:
             # I have to do exe extra checks anyways because you can request an arbitrary number of search results
             if not permissions.allow_playlists and ':search' in info['extractor'] and len(info['entries']) > 1:
@@ -1149,7 +1360,8 @@ class MusicBot(discord.Client):
             # TODO: I can create an event emitter object instead, add event functions, and every play list might be asyncified
             #       Also have a "verify_entry" hook with the entry as an arg and returns the entry if its ok
 
-            entry_list, position = await player.playlist.import_from(song_url, channel=channel, author=author)
+            entry_list, position = await player.playlist.import_from(
+                song_url, max_duration=permissions.max_song_length, channel=channel, author=author)
 
             tnow = time.time()
             ttime = tnow - t0
@@ -1157,13 +1369,11 @@ class MusicBot(discord.Client):
             drop_count = 0
 
             if permissions.max_song_length:
-                for e in entry_list.copy():
-                    if e.duration > permissions.max_song_length:
-                        player.playlist.entries.remove(e)
-                        entry_list.remove(e)
-                        drop_count += 1
-                        # Im pretty sure there's no situation where this would ever break
-                        # Unless the first entry starts being played, which would make this a race condition
+                dropped = set(player.playlist.remove_entries(
+                    [e for e in entry_list if e.duration > permissions.max_song_length]))
+                entry_list = [e for e in entry_list if e not in dropped]
+                drop_count = len(dropped)
+
                 if drop_count:
                     print("Verwijderde %s nummers" % drop_count)
 
@@ -1194,7 +1404,7 @@ class MusicBot(discord.Client):
                 )
 
             try:
-                entry, position = await player.playlist.add_entry(song_url, channel=channel, author=author)
+                entry, position = await player.playlist.add_entry(song_url, head=head, channel=channel, author=author)
 
             except exceptions.WrongEntryTypeError as e:
                 if e.use_url == song_url:
@@ -1204,7 +1414,7 @@ class MusicBot(discord.Client):
                     print("[Info] Ging er van uit dat \"%s\" slechts één nummer was, maar was stiekem een playlist" % song_url)
                     print("[Info] Gebruikt \"%s\" in plaats van" % e.use_url)
 
-                return await self.cmd_play(player, channel, author, permissions, leftover_args, e.use_url)
+                return await self._cmd_play(player, channel, author, permissions, leftover_args, e.use_url, head=head)
 
 
             if random.randrange(1,20) == 10:
@@ -1299,7 +1509,7 @@ class MusicBot(discord.Client):
         if extractor_type == 'youtube:playlist':
             try:
                 entries_added = await player.playlist.async_process_youtube_playlist(
-                    playlist_url, channel=channel, author=author)
+                    playlist_url, max_duration=permissions.max_song_length, channel=channel, author=author)
                 # TODO: Add hook to be called after each song
                 # TODO: Add permissions
 
@@ -1310,7 +1520,7 @@ class MusicBot(discord.Client):
         elif extractor_type.lower() in ['soundcloud:set', 'bandcamp:album']:
             try:
                 entries_added = await player.playlist.async_process_sc_bc_playlist(
-                    playlist_url, channel=channel, author=author)
+                    playlist_url, max_duration=permissions.max_song_length, channel=channel, author=author)
                 # TODO: Add hook to be called after each song
                 # TODO: Add permissions
 
@@ -1324,14 +1534,11 @@ class MusicBot(discord.Client):
         skipped = False
 
         if permissions.max_song_length:
-            for e in entries_added.copy():
-                if e.duration > permissions.max_song_length:
-                    try:
-                        player.playlist.entries.remove(e)
-                        entries_added.remove(e)
-                        drop_count += 1
-                    except:
-                        pass
+            # Songs that already started playing aren't in the queue anymore, those are handled below.
+            dropped = set(player.playlist.remove_entries(
+                [e for e in entries_added if e.duration > permissions.max_song_length]))
+            entries_added = [e for e in entries_added if e not in dropped]
+            drop_count = len(dropped)
 
             if drop_count:
                 print("Verwijderde %s nummers" % drop_count)
@@ -1348,7 +1555,7 @@ class MusicBot(discord.Client):
         songs_added = len(entries_added)
         tnow = time.time()
         ttime = tnow - t0
-        wait_per_song = 1.2
+        wait_per_song = 1.2 / PLAYLIST_CONCURRENCY
         # TODO: actually calculate wait per song in the process function and return that too
 
         # This is technically inaccurate since bad songs are ignored but still take up time
@@ -1517,9 +1724,10 @@ class MusicBot(discord.Client):
             song_total = str(timedelta(seconds=player.current_entry.duration)).lstrip('0').lstrip(':')
             prog_str = '`[%s/%s]`' % (song_progress, song_total)
 
-            if player.current_entry.meta.get('channel', False) and player.current_entry.meta.get('author', False):
+            meta = player.current_entry.meta
+            if meta.get('channel', False) and meta.get('author', False):
                 np_text = "Speelt nu af: **%s** toegevoegd door **%s** %s\n" % (
-                    player.current_entry.title, player.current_entry.meta['author'].name, prog_str)
+                    player.current_entry.title, meta['author'].name, prog_str)
             else:
                 np_text = "Speelt nu af: **%s** %s\n" % (player.current_entry.title, prog_str)
 
@@ -1531,6 +1739,60 @@ class MusicBot(discord.Client):
                 delete_after=30
             )
 
+    async def cmd_meter(self, player):
+        """
+        Uitleg:
+            ;meter
+
+        Laat zien hoe hard het nummer dat nu gespeeld wordt op dit moment is.
+        """
+
+        if player.is_playing and player.is_pre_encoded:
+            return Response('Het nummer dat nu speelt is vooraf gecodeerd, daarvan kan het volume niet gemeten worden.',
+                            delete_after=10)
+
+        meter = player.meter
+        was_active = meter.active
+        meter.activate()
+
+        if player.is_playing and not was_active:
+            # The meter only measures while someone is looking, give it a moment to pick up some frames.
+            await asyncio.sleep(0.5)
+
+        if not player.is_playing or not meter.levels:
+            return Response('Er wordt op dit moment niets afgespeeld.', delete_after=10)
+
+        return Response('`[%s]` %s dBFS (gemiddeld %s, piek %s)' % (
+            meter.bar(),
+            self._fixg(meter.to_dbfs(meter.current), 1),
+            self._fixg(meter.to_dbfs(meter.average), 1),
+            self._fixg(meter.to_dbfs(meter.peak), 1)), delete_after=20)
+
+    async def cmd_seek(self, player, position):
+        """
+        Uitleg:
+            ;seek [seconden | mm:ss]
+
+        Spoelt het nummer dat nu speelt door (of terug) naar een tijdstip.
+        """
+
+        if not player.current_entry:
+            raise exceptions.CommandError('Er wordt op dit moment niets afgespeeld.', expire_in=20)
+
+        try:
+            seconds = 0
+            for part in position.split(':'):
+                seconds = seconds * 60 + int(part)
+        except ValueError:
+            raise exceptions.CommandError('`%s` is geen tijdstip, gebruik seconden of mm:ss.' % position, expire_in=20)
+
+        seconds = player.seek(seconds)
+        if seconds is None:
+            raise exceptions.CommandError('Het nummer wordt nog gestart, probeer het zo nog eens.', expire_in=20)
+
+        return Response('Doorgespoeld naar `%s`.' % str(timedelta(seconds=int(seconds))).lstrip('0').lstrip(':'),
+                        delete_after=15)
+
     async def cmd_summon(self, channel, author, voice_channel):
         """
         Uitleg:
@@ -1633,6 +1895,47 @@ class MusicBot(discord.Client):
         player.playlist.clear()
         return Response(':put_litter_in_its_place:', delete_after=20)
 
+    async def cmd_remove(self, player, author, permissions, position):
+        """
+        Uitleg:
+            ;remove positie
+
+        Haalt het nummer op die positie (zie ;queue) uit de wachtrij.  Nummers van anderen kunnen alleen
+        verwijderd worden als je ook nummers van anderen mag overslaan.
+        """
+
+        try:
+            position = int(position)
+            entry = player.playlist.entry_at(position)
+        except (ValueError, IndexError):
+            raise exceptions.CommandError('Er staat geen nummer op positie `%s` in de wachtrij.' % position, expire_in=20)
+
+        if author.id != self.config.owner_id and not permissions.instaskip and author.id != entry.author_id:
+            raise exceptions.PermissionsError('Je kan alleen je eigen nummers uit de wachtrij halen.', expire_in=20)
+
+        player.playlist.remove_at(position)
+        return Response('**%s** is uit de wachtrij gehaald.' % entry.title, delete_after=20)
+
+    async def cmd_move(self, player, author, permissions, position, new_position):
+        """
+        Uitleg:
+            ;move positie nieuwe_positie
+
+        Verplaatst het nummer op die positie in de wachtrij (zie ;queue) naar een nieuwe positie.
+        """
+
+        if author.id != self.config.owner_id and not permissions.instaskip:
+            raise exceptions.PermissionsError('Je mag de wachtrij niet omgooien.', expire_in=20)
+
+        try:
+            position, new_position = int(position), int(new_position)
+            entry = player.playlist.move(position, new_position)
+        except (ValueError, IndexError):
+            raise exceptions.CommandError('Er staat geen nummer op positie `%s` in de wachtrij.' % position, expire_in=20)
+
+        return Response('**%s** staat nu op positie %s.' % (entry.title, player.playlist.position_of(entry)),
+                        delete_after=20)
+
     async def cmd_skip(self, player, channel, author, message, permissions, voice_channel):
         """
         Uitleg:
@@ -1662,7 +1965,7 @@ class MusicBot(discord.Client):
 
         if author.id == self.config.owner_id \
                 or permissions.instaskip \
-                or author == player.current_entry.meta.get('author', None):
+                or author.id == player.current_entry.author_id:
 
             player.skip()  # check autopause stuff here
             await self._manual_delete_check(message)
@@ -1830,16 +2133,18 @@ class MusicBot(discord.Client):
             song_total = str(timedelta(seconds=player.current_entry.duration)).lstrip('0').lstrip(':')
             prog_str = '`[%s/%s]`' % (song_progress, song_total)
 
-            if player.current_entry.meta.get('channel', False) and player.current_entry.meta.get('author', False):
+            meta = player.current_entry.meta
+            if meta.get('channel', False) and meta.get('author', False):
                 now_playing_queue = ("**%s** toegevoegd door **%s** %s\n" % (
-                    player.current_entry.title, player.current_entry.meta['author'].name, prog_str))
+                    player.current_entry.title, meta['author'].name, prog_str))
                 title = 'Speelt nu:'
             else:
                 lines.append("Speelt nu: **%s** %s\n" % (player.current_entry.title, prog_str))
 
         for i, item in enumerate(player.playlist, 1):
-            if item.meta.get('channel', False) and item.meta.get('author', False):
-                nextline = '`{}.` **{}** toegevoegd door **{}**'.format(i, item.title, item.meta['author'].name).strip()
+            meta = item.meta  # looks up the channel and author, once is enough
+            if meta.get('channel', False) and meta.get('author', False):
+                nextline = '`{}.` **{}** toegevoegd door **{}**'.format(i, item.title, meta['author'].name).strip()
             else:
                 nextline = '`{}.` **{}**'.format(i, item.title).strip()
 
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import asyncio
+import traceback
+
+from collections import namedtuple
+
+from .constants import AUDIO_CACHE_HISTORY_PATH, CONTENT_STORE_PATH
+from .utils import load_json, write_file_atomic
+
+CachedFile = namedtuple('CachedFile', 'path size mtime')
+
+# Leftovers of unfinished downloads, ytdl picks these up again by itself.
+PARTIAL_SUFFIXES = ('.part', '.ytdl')
+
+
+class AudioCacheIndex:
+    """
+        Keeps track of what's in the audio cache folder, so finding out if a song is already downloaded
+        doesn't mean listing the whole folder every time.
+
+        The folder is scanned once with `build`, after that the downloader tells us about everything it adds
+        (`add`) or deletes (`remove`).  Files are looked up by their full name, by their name without the
+        extension, or by the part before the last dash (which is how the generic extractor's files are named).
+        Lookups never touch the disk, `check` makes sure a file is actually still there.
+    """
+
+    def __init__(self, folder, fs):
+        self.folder = folder
+        self.fs = fs
+        self._files = {}      # name -> CachedFile
+        self._by_stem = {}    # name without extension -> [names]
+        self._by_prefix = {}  # name up to the last dash -> [names]
+        self.size = 0         # total size of the files, kept up to date by add and remove
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return iter(list(self._files.values()))
+
+    def build(self):
+        self.clear()
+
+        try:
+            files = sorted((f for f in os.scandir(self.folder) if f.is_file()), key=lambda f: f.name)
+        except FileNotFoundError:
+            return
+
+        for f in files:
+            if not f.name.endswith(PARTIAL_SUFFIXES):
+                self.add(f.path, f.stat())
+
+    def clear(self):
+        self._files.clear()
+        self._by_stem.clear()
+        self._by_prefix.clear()
+        self.size = 0
+
+    def add(self, path, stat=None):
+        """
+            Adds (or updates) the file at `path`, stat'ing it unless `stat` is given.
+            Returns the CachedFile, or None if there's no such file.
+        """
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.remove(path)
+                return None
+
+        name = os.path.basename(path)
+        old = self._files.get(name)
+        cached = self._files[name] = CachedFile(os.path.join(self.folder, name), stat.st_size, stat.st_mtime)
+        self.size += cached.size - (old.size if old else 0)
+
+        if old is None:
+            # Like the old listdir scan, the first file wins when several share a stem or prefix.
+            self._by_stem.setdefault(name.rsplit('.', 1)[0], []).append(name)
+            self._by_prefix.setdefault(name.rsplit('-', 1)[0], []).append(name)
+
+        return cached
+
+    def remove(self, path):
+        name = os.path.basename(path)
+        cached = self._files.pop(name, None)
+
+        if cached is None:
+            return
+
+        self.size -= cached.size
+
+        for index, key in ((self._by_stem, name.rsplit('.', 1)[0]), (self._by_prefix, name.rsplit('-', 1)[0])):
+            names = index[key]
+            names.remove(name)
+
+            if not names:
+                del index[key]
+
+    async def add_async(self, path):
+        """
+            Like `add`, but without blocking the event loop.
+        """
+        try:
+            stat = await self.fs.stat(path)
+        except OSError:
+            self.remove(path)
+            return None
+
+        return self.add(path, stat)
+
+    def get(self, name):
+        return self._files.get(name) if name else None
+
+    async def check(self, cached):
+        """
+            Returns `cached` if the file is still there.  If it was deleted behind our back, it's forgotten.
+        """
+        if cached is None or await self.fs.isfile(cached.path):
+            return cached
+
+        self.remove(cached.path)
+        return None
+
+    def find_stem(self, stem):
+        """
+            Returns the file named `stem` with any extension.
+        """
+        names = self._by_stem.get(stem)
+        return self.get(names[0]) if names else None
+
+    def find_prefix(self, prefix):
+        """
+            Returns the file whose name is `prefix` followed by a dash and anything else.
+        """
+        names = self._by_prefix.get(prefix)
+        return self.get(names[0]) if names else None
+
+
+class CacheManager:
+    """
+        Keeps the audio cache under `budget` bytes by deleting the songs that are least likely to be played
+        again.  With the 'lru' policy that's the song that was played longest ago, with 'lfu' the song that
+        was played the least often (longest ago breaks ties).
+
+        How often and when each file was played is saved to `path` so it survives restarts, along with
+        anything else worth remembering about a file (see `update`).  Files returned by `pinned` (a callable
+        returning file names) and files of songs on the autoplaylist are never deleted.
+        Without a budget nothing is deleted, but the metadata is still kept.
+    """
+
+    POLICIES = ('lru', 'lfu')
+
+    def __init__(self, index, path=AUDIO_CACHE_HISTORY_PATH, *, budget=0, policy='lru', pinned=None, autoplaylist=()):
+        self.index = index
+        self.path = path
+        self.budget = budget
+        self.policy = policy if policy in self.POLICIES else 'lru'
+        self.pinned = pinned or (lambda: ())
+        self.autoplaylist = autoplaylist
+        self.on_evict = None  # coroutine function called with the path of every file that was deleted
+
+        self.history = {}  # file name -> {'url': str, 'last_played': float, 'plays': int, 'loudness': float, ...}
+        self.evictions = 0
+        self._dirty = False
+        self._warned = False
+
+        self.load()
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def load(self):
+        self.history = load_json(self.path, 'audio cache history')
+
+    def save(self):
+        """
+            Writes the history to disk right away, for when the loop isn't running anymore.
+        """
+        if self._dirty:
+            write_file_atomic(self.path, json.dumps(self.history))
+            self._dirty = False
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        self._dirty = False
+
+        try:
+            await self.index.fs.run(write_file_atomic, self.path, json.dumps(self.history))
+        except OSError:
+            self._dirty = True
+            traceback.print_exc()
+
+    def get(self, filename):
+        return self.history.get(os.path.basename(filename), {})
+
+    def update(self, filename, **values):
+        self.history.setdefault(os.path.basename(filename), {'plays': 0}).update(values)
+        self._dirty = True
+
+    def record_play(self, url, filename):
+        name = os.path.basename(filename)
+        record = self.history.setdefault(name, {'plays': 0})
+
+        record['url'] = url
+        record['last_played'] = time.time()
+        record['plays'] += 1
+        self._dirty = True
+
+    def _rank(self, cached):
+        record = self.history.get(os.path.basename(cached.path), {})
+        last_played = record.get('last_played', cached.mtime)
+
+        if self.policy == 'lfu':
+            return record.get('plays', 0), last_played
+
+        return last_played
+
+    def _is_pinned(self, name, pinned, autoplaylist):
+        return name in pinned or self.history.get(name, {}).get('url') in autoplaylist
+
+    async def evict(self):
+        """
+            Deletes files until the cache fits in the budget again.  Returns the number of bytes freed.
+        """
+        # Forget about files that are gone.
+        for name in [name for name in self.history if self.index.get(name) is None]:
+            del self.history[name]
+            self._dirty = True
+
+        size = self.index.size
+        if not self.enabled or size <= self.budget:
+            return 0
+
+        pinned = set(self.pinned())
+        autoplaylist = set(self.autoplaylist)
+        candidates = sorted(
+            (c for c in self.index if not self._is_pinned(os.path.basename(c.path), pinned, autoplaylist)),
+            key=self._rank)
+
+        freed = 0
+
+        for cached in candidates:
+            if size - freed <= self.budget:
+                break
+
+            try:
+                await self.index.fs.unlink(cached.path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Probably still being played somewhere, try again next time.
+                continue
+
+            self.index.remove(cached.path)
+
+            if self.on_evict:
+                await self.on_evict(cached.path)
+
+            self.history.pop(os.path.basename(cached.path), None)
+            self._dirty = True
+            self.evictions += 1
+            freed += cached.size
+
+        if size - freed > self.budget and not self._warned:
+            self._warned = True
+            print("[Warning] The audio cache is over its budget, but everything left in it is in use "
+                  "or on the autoplaylist")
+
+        return freed
+
+    async def run(self, interval=60):
+        while True:
+            try:
+                freed = await self.evict()
+
+                if freed:
+                    print("[Cache] Freed %s MB from the audio cache" % round(freed / (1024 * 1024), 1))
+
+                await self.flush()
+            except:
+                traceback.print_exc()
+            finally:
+                await asyncio.sleep(interval)
+
+
+class ContentStore:
+    """
+        Stores downloads under the hash of their contents (`<sha256>.<ext>`) and remembers which url
+        ended up in which file.  Different urls serving the same audio share a single file.
+    """
+
+    def __init__(self, index, path=CONTENT_STORE_PATH):
+        self.index = index
+        self.path = path
+        self.urls = load_json(path, 'content store')  # url -> file name
+        self.deduplicated = 0
+
+    async def save(self):
+        try:
+            await self.index.fs.run(write_file_atomic, self.path, json.dumps(self.urls))
+        except OSError:
+            traceback.print_exc()
+
+    def get(self, url):
+        """
+            Returns the CachedFile holding the audio of `url`, if we have it.
+        """
+        name = self.urls.get(url)
+
+        if name is None:
+            return None
+
+        cached = self.index.get(name)
+
+        if cached is None:
+            # The file has been deleted since, the mapping is saved without it with the next download.
+            del self.urls[url]
+
+        return cached
+
+    async def add(self, url, path, digest, ext):
+        """
+            Moves the finished download at `path` into the store and returns where it ended up.
+            If the same audio was already stored, the download is thrown away and the existing file is used.
+        """
+        name = '%s.%s' % (digest, ext)
+        final = os.path.join(self.index.folder, name)
+
+        if self.index.get(name) or await self.index.fs.isfile(final):
+            await self.index.fs.unlink(path)
+            self.deduplicated += 1
+        else:
+            await self.index.fs.replace(path, final)
+
+        await self.index.add_async(final)
+        self.urls[url] = name
+        await self.save()
+
+        return final
@@ -78,6 +78,21 @@ class Config:
         self.delete_messages  = config.getboolean('MusicBot', 'DeleteMessages', fallback=ConfigDefaults.delete_messages)
         self.delete_invoking = config.getboolean('MusicBot', 'DeleteInvoking', fallback=ConfigDefaults.delete_invoking)
         self.debug_mode = config.getboolean('MusicBot', 'DebugMode', fallback=ConfigDefaults.debug_mode)
+        self.metadata_cache_ttl = config.getint('MusicBot', 'MetadataCacheTTL', fallback=ConfigDefaults.metadata_cache_ttl)
+        self.metadata_cache_size = config.getint('MusicBot', 'MetadataCacheSize', fallback=ConfigDefaults.metadata_cache_size)
+        self.stream_mode = config.getboolean('MusicBot', 'StreamMode', fallback=ConfigDefaults.stream_mode)
+        self.gapless_playback = config.getboolean('MusicBot', 'GaplessPlayback', fallback=ConfigDefaults.gapless_playback)
+        self.prefetch_count = config.getint('MusicBot', 'PrefetchCount', fallback=ConfigDefaults.prefetch_count)
+        self.prefetch_seconds = config.getint('MusicBot', 'PrefetchSeconds', fallback=ConfigDefaults.prefetch_seconds)
+        self.prefetch_disk_budget = config.getint('MusicBot', 'PrefetchDiskBudget', fallback=ConfigDefaults.prefetch_disk_budget)
+        self.extractor_processes = config.getint('MusicBot', 'ExtractorProcesses', fallback=ConfigDefaults.extractor_processes)
+        self.normalize_loudness = config.getboolean('MusicBot', 'NormalizeLoudness', fallback=ConfigDefaults.normalize_loudness)
+        self.loudness_target = config.getfloat('MusicBot', 'LoudnessTarget', fallback=ConfigDefaults.loudness_target)
+        self.spare_decoders = config.getint('MusicBot', 'SpareDecoders', fallback=ConfigDefaults.spare_decoders)
+        self.opus_cache = config.getboolean('MusicBot', 'OpusCache', fallback=ConfigDefaults.opus_cache)
+        self.cache_budget = config.getint('MusicBot', 'CacheBudget', fallback=ConfigDefaults.cache_budget)
+        self.cache_policy = config.get('MusicBot', 'CachePolicy', fallback=ConfigDefaults.cache_policy).strip().lower()
+        self.queue_snapshot_interval = config.getint('MusicBot', 'QueueSnapshotInterval', fallback=ConfigDefaults.queue_snapshot_interval)
 
         self.blacklist_file = config.get('Files', 'BlacklistFile', fallback=ConfigDefaults.blacklist_file)
         self.auto_playlist_file = config.get('Files', 'AutoPlaylistFile', fallback=ConfigDefaults.auto_playlist_file)
@@ -155,6 +170,10 @@ class Config:
 
         self.delete_invoking = self.delete_invoking and self.delete_messages
 
+        if self.cache_policy not in ('lru', 'lfu'):
+            print("[Warning] CachePolicy should be lru or lfu, not %s. Using lru." % self.cache_policy)
+            self.cache_policy = ConfigDefaults.cache_policy
+
         self.bound_channels = set(item.replace(',', ' ').strip() for item in self.bound_channels)
 
         self.autojoin_channels = set(item.replace(',', ' ').strip() for item in self.autojoin_channels)
@@ -187,6 +206,21 @@ class ConfigDefaults:
     delete_messages = True
     delete_invoking = False
     debug_mode = False
+    metadata_cache_ttl = 21600
+    metadata_cache_size = 64
+    stream_mode = False
+    gapless_playback = False
+    prefetch_count = 1
+    prefetch_seconds = 0
+    prefetch_disk_budget = 0
+    extractor_processes = 0
+    normalize_loudness = False
+    loudness_target = -18.0
+    spare_decoders = 0
+    opus_cache = False
+    cache_budget = 0
+    cache_policy = 'lru'
+    queue_snapshot_interval = 30
 
     options_file = 'config/options.ini'
     blacklist_file = 'config/blacklist.txt'
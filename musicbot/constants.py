@@ -5,4 +5,9 @@ SUB_VERSION = ''
 VERSION = MAIN_VERSION + SUB_VERSION
 
 AUDIO_CACHE_PATH = os.path.join(os.getcwd(), 'audio_cache')
+DATA_PATH = os.path.join(os.getcwd(), 'data')
+METADATA_CACHE_PATH = os.path.join(DATA_PATH, 'metadata_cache.sqlite')
+AUDIO_CACHE_HISTORY_PATH = os.path.join(DATA_PATH, 'audio_cache.json')
+CONTENT_STORE_PATH = os.path.join(DATA_PATH, 'content_store.json')
+QUEUE_SNAPSHOT_PATH = os.path.join(DATA_PATH, 'queues.json')
 DISCORD_MSG_CHAR_LIMIT = 2000
@@ -0,0 +1,145 @@
+import os
+import shutil
+import threading
+import subprocess
+
+# These keep their index at the end of the file more often than not, ffmpeg can't read them from a pipe.
+UNPIPEABLE = ('.m4a', '.mp4', '.m4v', '.mov', '.3gp')
+
+
+class DecoderPool:
+    """
+        Keeps a few ffmpeg processes started and waiting for input on stdin, so a song doesn't have to wait
+        for ffmpeg to start up.  A file is handed to a waiting process by a thread writing it to its stdin,
+        the pcm comes out of stdout the same way it does for discord's own ffmpeg player.
+
+        There are `per_player` spare processes for every MusicPlayer, see `resize`.
+    """
+
+    def __init__(self, *, per_player=1, sampling_rate=48000, channels=2):
+        self.per_player = per_player
+        self.size = 0
+        self.args = [
+            'ffmpeg', '-i', 'pipe:0', '-vn', '-f', 's16le', '-ar', str(sampling_rate), '-ac', str(channels),
+            '-loglevel', 'warning', 'pipe:1'
+        ]
+
+        self.handed_out = 0
+        self.spawned = 0
+        self.broken = False
+
+        self._spare = []
+        self._starting = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.per_player > 0 and not self.broken
+
+    @property
+    def spare(self):
+        return len(self._spare)
+
+    def resize(self, players):
+        """
+            Sizes the pool for `players` MusicPlayers.
+        """
+        self.size = players * self.per_player if self.enabled else 0
+
+        with self._lock:
+            while len(self._spare) > self.size:
+                self._kill(self._spare.pop())
+
+        self._refill()
+
+    def _spawn(self):
+        try:
+            process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        except OSError as e:
+            print("[Warning] Could not start spare ffmpeg processes (%s), starting them when needed instead" % e)
+            self.broken = True
+            self.size = 0
+            return None
+
+        self.spawned += 1
+        return process
+
+    def _refill(self):
+        """
+            Starts processes until the pool is full again, in a thread so the caller doesn't wait for it.
+        """
+        def refill():
+            while True:
+                with self._lock:
+                    if len(self._spare) + self._starting >= self.size:
+                        return
+                    self._starting += 1
+
+                process = self._spawn()
+
+                with self._lock:
+                    self._starting -= 1
+
+                    if process is None:
+                        return
+                    self._spare.append(process)
+
+        threading.Thread(target=refill, name='decoder pool refill', daemon=True).start()
+
+    @staticmethod
+    def _kill(process):
+        try:
+            process.kill()
+            process.wait()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _feed(process, filename):
+        try:
+            with open(filename, 'rb') as f:
+                shutil.copyfileobj(f, process.stdin, 64 * 1024)
+
+        except OSError:
+            pass  # The player was stopped and took ffmpeg with it, or the file is gone
+
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def take(self, filename):
+        """
+            Returns a waiting ffmpeg process that's being fed `filename`, or None if there's none to spare
+            or the file can't be decoded from a pipe.
+        """
+        if not self.enabled or os.path.splitext(filename)[1].lower() in UNPIPEABLE:
+            return None
+
+        process = None
+
+        with self._lock:
+            while self._spare and process is None:
+                process = self._spare.pop()
+
+                if process.poll() is not None:
+                    # Died while waiting, no use to anyone.
+                    process = None
+
+        if process is None:
+            return None
+
+        threading.Thread(target=self._feed, args=(process, filename), name='decoder feeder', daemon=True).start()
+        self.handed_out += 1
+        self._refill()
+
+        return process
+
+    def shutdown(self):
+        self.size = 0
+
+        with self._lock:
+            while self._spare:
+                self._kill(self._spare.pop())
@@ -1,9 +1,25 @@
 import os
+import copy
+import json
+import time
+import zlib
+import sqlite3
 import asyncio
 import functools
+import threading
+import traceback
 import youtube_dl
+import urllib.parse
 
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .cache import AudioCacheIndex, ContentStore
+from .constants import METADATA_CACHE_PATH
+from .exceptions import DownloadPreempted
+from .fs import FileSystem
+from .scheduler import DownloadScheduler
 
 ytdl_format_options = {
     'format': 'bestaudio/best',
@@ -21,6 +37,9 @@ ytdl_format_options = {
     'source_address': '0.0.0.0'
 }
 
+# Cache hits are written to the metadata cache at most this many at a time, see MetadataCache.get
+ATIME_BATCH = 50
+
 # Fuck your useless bugreports message that gets two link embeds and confuses users
 youtube_dl.utils.bug_reports_message = lambda: ''
 
@@ -32,36 +51,435 @@ youtube_dl.utils.bug_reports_message = lambda: ''
 
 '''
 
+
+def _make_ytdl(download_folder=None, *, safe=False):
+    ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+
+    if safe:
+        ytdl.params['ignoreerrors'] = True
+
+    if download_folder:
+        ytdl.params['outtmpl'] = os.path.join(download_folder, ytdl.params['outtmpl'])
+
+    return ytdl
+
+
+# These travel between the bot and the extractor processes, so they have to stay picklable.
+ExtractionRequest = namedtuple('ExtractionRequest', 'url safe download process download_folder')
+ExtractionResponse = namedtuple('ExtractionResponse', 'info error')
+
+# The ytdl objects of an extractor process, created once and reused for every request it handles.
+_worker_ytdls = {}
+
+
+def _worker_ytdl(safe, download_folder):
+    ytdl = _worker_ytdls.get((safe, download_folder))
+
+    if ytdl is None:
+        ytdl = _worker_ytdls[safe, download_folder] = _make_ytdl(download_folder, safe=safe)
+
+    return ytdl
+
+
+def _worker_warmup(download_folder):
+    _worker_ytdl(False, download_folder)
+    _worker_ytdl(True, download_folder)
+
+
+def _worker_extract(request):
+    """
+        Runs in an extractor process.  Errors are sent back as text since ytdl's exceptions don't survive pickling.
+    """
+    try:
+        ytdl = _worker_ytdl(request.safe, request.download_folder)
+        info = ytdl.extract_info(request.url, download=request.download, process=request.process)
+
+    except Exception as e:
+        return ExtractionResponse(None, str(e) or e.__class__.__name__)
+
+    # Unprocessed playlists come with a generator of entries, which can't be sent back as is.
+    if info and info.get('entries') is not None and not isinstance(info['entries'], list):
+        try:
+            info['entries'] = list(info['entries'])
+        except Exception as e:
+            return ExtractionResponse(None, str(e) or e.__class__.__name__)
+
+    return ExtractionResponse(info, None)
+
+
+class MetadataCache:
+    """
+        An on-disk cache for ytdl metadata lookups, keyed by the normalized url, the `process` flag and whether
+        the lookup was allowed to skip errors.
+
+        Entries expire after `ttl` seconds and the least recently used ones are evicted once the stored
+        (compressed) data grows past `max_size` bytes.  The recency order is kept in memory so lookups
+        are a single indexed sqlite read, it's only written to the database every now and then.
+    """
+
+    def __init__(self, path=METADATA_CACHE_PATH, *, ttl=21600, max_size=64 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+        self._db = None
+        self._index = OrderedDict()  # key -> (expires, size), least recently used first
+        self._touched = {}  # key -> time of the last hit, for the hits that aren't in the database yet
+
+        if ttl > 0 and max_size > 0:
+            self._open()
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def enabled(self):
+        return self._db is not None
+
+    def _open(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            db = sqlite3.connect(self.path)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, expires REAL, atime REAL, data BLOB)')
+            db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),))
+            db.commit()
+
+            for key, expires, size in db.execute('SELECT key, expires, length(data) FROM metadata ORDER BY atime'):
+                self._index[key] = (expires, size)
+                self.size += size
+
+        except (sqlite3.Error, OSError) as e:
+            print("[Warning] Could not open the metadata cache at %s (%s), lookups will not be cached" % (self.path, e))
+            return
+
+        self._db = db
+        self._evict()
+
+    @staticmethod
+    def make_key(url, process=True, safe=True):
+        """
+            Normalizes `url` so trivially different spellings of the same link share a cache entry.
+        """
+        url = url.strip().strip('<>')
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme and parts.netloc:
+            query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+            url = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+        return '%s|%d|%d' % (url, bool(process), bool(safe))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+
+        item = self._index.get(key)
+        now = time.time()
+
+        if item is None or item[0] < now:
+            if item is not None:
+                self._remove(key)
+
+            self.misses += 1
+            return None
+
+        try:
+            row = self._db.execute('SELECT data FROM metadata WHERE key = ?', (key,)).fetchone()
+            info = json.loads(zlib.decompress(row[0]).decode('utf8'))
+
+        except (sqlite3.Error, TypeError, ValueError, zlib.error) as e:
+            print("[Warning] Dropping broken metadata cache entry %s (%s)" % (key, e))
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._index.move_to_end(key)
+        self.hits += 1
+
+        # Writing the access time on every hit would mean a commit per lookup, it goes along with the next one.
+        self._touched[key] = now
+        if len(self._touched) >= ATIME_BATCH:
+            self.flush()
+
+        return info
+
+    def put(self, key, info):
+        if not self.enabled or not info:
+            return
+
+        try:
+            data = zlib.compress(json.dumps(info, separators=(',', ':')).encode('utf8'))
+        except (TypeError, ValueError):
+            # Unprocessed playlists hold a lazy generator of entries, those can't be cached.
+            return
+
+        if len(data) > self.max_size:
+            return
+
+        now = time.time()
+
+        try:
+            self._touched.pop(key, None)
+            self._write_atimes()
+            self._db.execute(
+                'INSERT OR REPLACE INTO metadata (key, expires, atime, data) VALUES (?, ?, ?, ?)',
+                (key, now + self.ttl, now, data))
+            self._db.commit()
+
+        except sqlite3.Error as e:
+            print("[Warning] Could not write to the metadata cache (%s)" % e)
+            return
+
+        old = self._index.pop(key, None)
+        if old:
+            self.size -= old[1]
+
+        self._index[key] = (now + self.ttl, len(data))
+        self.size += len(data)
+        self._evict()
+
+    def flush(self):
+        """
+            Writes the access times of recent hits to the database.
+        """
+        if not self.enabled or not self._touched:
+            return
+
+        try:
+            self._write_atimes()
+            self._db.commit()
+        except sqlite3.Error as e:
+            print("[Warning] Could not write to the metadata cache (%s)" % e)
+
+    def _write_atimes(self):
+        touched, self._touched = self._touched, {}
+        self._db.executemany('UPDATE metadata SET atime = ? WHERE key = ?', [(t, k) for k, t in touched.items()])
+
+    def _remove(self, key):
+        expires, size = self._index.pop(key)
+        self.size -= size
+        self._touched.pop(key, None)
+
+        try:
+            self._db.execute('DELETE FROM metadata WHERE key = ?', (key,))
+            self._db.commit()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_size and self._index:
+            self._remove(next(iter(self._index)))
+
+
 class Downloader:
-    def __init__(self, download_folder=None):
-        self.thread_pool = ThreadPoolExecutor(max_workers=2)
-        self.unsafe_ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
-        self.safe_ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
-        self.safe_ytdl.params['ignoreerrors'] = True
+    def __init__(self, download_folder=None, *, cache_ttl=0, cache_size=0, processes=0, max_downloads=2, max_lookups=4):
+        # Keep threads free for lookups when the scheduler has every download slot busy, playlists are looked up
+        # a few songs at a time (see Playlist._add_entries_concurrently).
+        self.thread_pool = ThreadPoolExecutor(max_workers=max_downloads + max_lookups)
+        self.process_pool = None
+        self.scheduler = DownloadScheduler(max_concurrent=max_downloads)
+        self.metadata_cache = MetadataCache(ttl=cache_ttl, max_size=cache_size)
+
+        # Identical requests that are already running share a single job, see `_extract`.
+        self._inflight = {}
+        self.extractions = 0
+        self.coalesced = 0
+
+        self.unsafe_ytdl = _make_ytdl(download_folder)
+        self.safe_ytdl = _make_ytdl(download_folder, safe=True)
         self.download_folder = download_folder
 
-        if download_folder:
-            otmpl = self.unsafe_ytdl.params['outtmpl']
-            self.unsafe_ytdl.params['outtmpl'] = os.path.join(download_folder, otmpl)
-            # print("setting template to " + os.path.join(download_folder, otmpl))
+        self.fs = FileSystem()
+        self.cache_index = AudioCacheIndex(download_folder or os.getcwd(), self.fs)
+        self.cache_index.build()
+        self.content_store = ContentStore(self.cache_index)
+
+        # The cancel event of the job running in the current thread, checked from ytdl's progress hook and
+        # before every request ytdl makes.
+        self._local = threading.local()
+        for ytdl in (self.unsafe_ytdl, self.safe_ytdl):
+            ytdl.add_progress_hook(self._progress_hook)
+            ytdl.urlopen = self._cancellable(ytdl.urlopen)
+
+        if processes > 0:
+            self._start_process_pool(processes)
+
+    def _start_process_pool(self, processes):
+        """
+            ytdl's extractors are mostly cpu bound python and fight the voice thread for the GIL,
+            so if configured they run in their own processes, each with its own warm ytdl objects.
+        """
+        try:
+            self.process_pool = ProcessPoolExecutor(max_workers=processes)
+
+            for _ in range(processes):
+                self.process_pool.submit(_worker_warmup, self.download_folder)
 
-            otmpl = self.safe_ytdl.params['outtmpl']
-            self.safe_ytdl.params['outtmpl'] = os.path.join(download_folder, otmpl)
+        except Exception as e:
+            print("[Warning] Could not start the extractor processes (%s), using threads instead" % e)
+            self.process_pool = None
+
+    def shutdown(self):
+        self.metadata_cache.flush()
+
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
+
+        self.thread_pool.shutdown(wait=False)
+        self.fs.shutdown()
 
 
     @property
     def ytdl(self):
         return self.safe_ytdl
 
+    def _progress_hook(self, status):
+        cancel = getattr(self._local, 'cancel', None)
+
+        if cancel is not None and cancel.is_set() and status.get('status') == 'downloading':
+            # ytdl leaves the .part file behind and picks up where it left off next time.
+            raise DownloadPreempted("Download of %s was preempted" % status.get('filename'))
+
+    def _cancellable(self, urlopen):
+        # Lookups don't report any progress, but every page they fetch goes through here.
+        def wrapper(req, *args, **kwargs):
+            cancel = getattr(self._local, 'cancel', None)
+
+            if cancel is not None and cancel.is_set():
+                raise DownloadPreempted("Called off before fetching %s" % getattr(req, 'full_url', req))
+
+            return urlopen(req, *args, **kwargs)
+
+        return wrapper
+
+    def _call_ytdl(self, ytdl, cancel, *args, **kwargs):
+        if cancel is not None and cancel.is_set():
+            # Called off while it was waiting for a thread.
+            raise DownloadPreempted("Called off before it started")
+
+        self._local.cancel = cancel
+
+        try:
+            return ytdl.extract_info(*args, **kwargs)
+        finally:
+            self._local.cancel = None
+
+    def _cache_key(self, ytdl, args, kwargs):
+        # Only plain metadata lookups are cached, anything that downloads or passes extra options goes through.
+        if len(args) != 1 or kwargs.get('download', True) or set(kwargs) - {'download', 'process'}:
+            return None
+
+        # The safe ytdl skips over errors, what it found may be missing parts a strict lookup would have failed on.
+        return self.metadata_cache.make_key(args[0], kwargs.get('process', True), ytdl is self.safe_ytdl)
+
+    def _flight_key(self, ytdl, args, kwargs):
+        if len(args) != 1 or not isinstance(args[0], str):
+            return None
+
+        try:
+            options = frozenset(kwargs.items())
+            hash(options)
+        except TypeError:
+            return None
+
+        return ytdl is self.safe_ytdl, self.metadata_cache.make_key(args[0]), options
+
+    async def _run_extract(self, loop, ytdl, args, kwargs, cancel=None):
+        self.extractions += 1
+
+        # Only the threads can be told to stop, jobs that might have to (see DownloadScheduler) stay here.
+        if self.process_pool and cancel is None and len(args) == 1 and not set(kwargs) - {'download', 'process'}:
+            request = ExtractionRequest(
+                args[0], ytdl is self.safe_ytdl, kwargs.get('download', True), kwargs.get('process', True),
+                self.download_folder)
+
+            try:
+                response = await loop.run_in_executor(self.process_pool, _worker_extract, request)
+
+            except BrokenProcessPool:
+                print("[Warning] The extractor processes died, falling back to threads")
+                traceback.print_exc()
+                self.process_pool = None
+
+            except Exception as e:
+                # Most likely something in the result that couldn't be pickled, just do this one here.
+                print("[Warning] Extractor process failed on %s (%s), retrying in a thread" % (args[0], e))
+
+            else:
+                if response.error is not None:
+                    raise youtube_dl.utils.DownloadError(response.error)
+
+                return response.info
+
+        return await loop.run_in_executor(self.thread_pool, functools.partial(self._call_ytdl, ytdl, cancel, *args, **kwargs))
+
+    async def _extract(self, loop, ytdl, *args, cancel=None, use_cache=True, **kwargs):
+        key = self._cache_key(ytdl, args, kwargs) if use_cache and self.metadata_cache.enabled else None
+
+        if key is not None:
+            info = self.metadata_cache.get(key)
+            if info is not None:
+                return info
+
+        # A job that can be called off (a preempted download) can't be shared, the others would be called off too.
+        flight_key = self._flight_key(ytdl, args, kwargs) if cancel is None else None
+
+        if flight_key is None:
+            return await self._run_extract(loop, ytdl, args, kwargs, cancel)
+
+        flight = self._inflight.get(flight_key)
+
+        if flight is not None:
+            # Someone is already extracting this exact thing, wait for their result instead of starting another job.
+            self.coalesced += 1
+            flight[1] += 1
+            info = await asyncio.shield(flight[0])
+
+            try:
+                return copy.deepcopy(info)
+            except TypeError:
+                # Lazily generated playlist entries can only be consumed once, so we need our own.
+                return await self._run_extract(loop, ytdl, args, kwargs)
+
+        flight = self._inflight[flight_key] = [
+            asyncio.ensure_future(self._run_extract(loop, ytdl, args, kwargs, cancel), loop=loop), 0]
+        flight[0].add_done_callback(lambda f: self._inflight.pop(flight_key, None))
+
+        info = await asyncio.shield(flight[0])
+
+        if key is not None:
+            self.metadata_cache.put(key, info)
+
+        if flight[1]:
+            # Hand out a copy so the followers don't see any changes made to our result.
+            try:
+                return copy.deepcopy(info)
+            except TypeError:
+                pass
+
+        return info
+
     async def extract_info(self, loop, *args, on_error=None, retry_on_error=False, **kwargs):
         """
             Runs ytdl.extract_info within the threadpool. Returns a future that will fire when it's done.
             If `on_error` is passed and an exception is raised, the exception will be caught and passed to
             on_error as an argument.
+
+            Metadata lookups (`download=False`) are served from the metadata cache when possible, pass
+            `use_cache=False` when the result has to be fresh (media urls expire).
+            A threading.Event can be passed as `cancel`, setting it aborts the download or lookup with DownloadPreempted.
         """
         if callable(on_error):
             try:
-                return await loop.run_in_executor(self.thread_pool, functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs))
+                return await self._extract(loop, self.unsafe_ytdl, *args, **kwargs)
 
             except Exception as e:
 
@@ -79,7 +497,15 @@ class Downloader:
                 if retry_on_error:
                     return await self.safe_extract_info(loop, *args, **kwargs)
         else:
-            return await loop.run_in_executor(self.thread_pool, functools.partial(self.unsafe_ytdl.extract_info, *args, **kwargs))
+            return await self._extract(loop, self.unsafe_ytdl, *args, **kwargs)
 
     async def safe_extract_info(self, loop, *args, **kwargs):
-        return await loop.run_in_executor(self.thread_pool, functools.partial(self.safe_ytdl.extract_info, *args, **kwargs))
+        return await self._extract(loop, self.safe_ytdl, *args, **kwargs)
+
+    async def safe_process_info(self, loop, info):
+        """
+            Finishes a lookup that was made with process=False, without fetching `info` itself again.
+        """
+        self.extractions += 1
+        return await loop.run_in_executor(
+            self.thread_pool, functools.partial(self.safe_ytdl.process_ie_result, info, download=False))
@@ -1,17 +1,26 @@
 import asyncio
 import json
 import os
+import sys
+import tempfile
 import traceback
 
-from .exceptions import ExtractionError
-from .utils import get_header, md5sum
+from .exceptions import ExtractionError, DownloadPreempted
+from .scheduler import DownloadPriority
+from .utils import get_header, HashingWriter
+
+# How much of a download is read from the connection at once.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 class BasePlaylistEntry:
+    # Big queues hold a lot of these, slots keep them small (see `benchmark`).
+    __slots__ = ('filename', '_is_downloading', '_waiting_futures')
+
     def __init__(self):
         self.filename = None
         self._is_downloading = False
-        self._waiting_futures = []
+        self._waiting_futures = ()  # a tuple, so an entry nobody waits on doesn't need a list of its own
 
     @property
     def is_downloaded(self):
@@ -27,13 +36,16 @@ class BasePlaylistEntry:
     def to_json(self):
         raise NotImplementedError
 
-    async def _download(self):
+    async def _download(self, cancel=None):
         raise NotImplementedError
 
-    def get_ready_future(self):
+    def _schedule_download(self, priority):
+        asyncio.ensure_future(self._download())
+
+    def get_ready_future(self, priority=DownloadPriority.NEXT_UP):
         """
         Returns a future that will fire when the song is ready to be played. The future will either fire with the result (being the entry) or an exception
-        as to why the song download failed.
+        as to why the song download failed.  `priority` is how urgently the download is needed.
         """
         future = asyncio.Future()
         if self.is_downloaded:
@@ -42,17 +54,30 @@ class BasePlaylistEntry:
 
         else:
             # If we request a ready future, let's ensure that it'll actually resolve at one point.
-            asyncio.ensure_future(self._download())
-            self._waiting_futures.append(future)
+            self._waiting_futures += (future,)
+            self._schedule_download(priority)
 
         return future
 
+    def prefetch(self, priority=DownloadPriority.PREFETCH):
+        """
+        Starts downloading the song ahead of time, without anything waiting on it.
+        """
+        if not self.is_downloaded:
+            self._schedule_download(priority)
+
+    def cancel_prefetch(self):
+        """
+        Drops a download started by `prefetch` that hasn't started yet, unless something is waiting on it.
+        """
+        pass
+
     def _for_each_future(self, cb):
         """
             Calls `cb` for each future that is not cancelled. Absorbs and logs any errors that may have occurred.
         """
         futures = self._waiting_futures
-        self._waiting_futures = []
+        self._waiting_futures = ()
 
         for future in futures:
             if future.cancelled():
@@ -72,6 +97,8 @@ class BasePlaylistEntry:
 
 
 class URLPlaylistEntry(BasePlaylistEntry):
+    __slots__ = ('playlist', 'url', 'title', 'duration', 'expected_filename', 'channel_id', 'author_id', '_extra_meta')
+
     def __init__(self, playlist, url, title, duration=0, expected_filename=None, **meta):
         super().__init__()
 
@@ -80,124 +107,164 @@ class URLPlaylistEntry(BasePlaylistEntry):
         self.title = title
         self.duration = duration
         self.expected_filename = expected_filename
-        self.meta = meta
 
-        self.download_folder = self.playlist.downloader.download_folder
+        # The channel and author are kept as ids and looked up when they're needed, see `meta`.
+        channel = meta.pop('channel', None)
+        author = meta.pop('author', None)
+        self.channel_id = channel.id if channel else None
+        self.author_id = author.id if author else None
+        self._extra_meta = meta or None
+
+    @property
+    def download_folder(self):
+        return self.playlist.downloader.download_folder
+
+    @property
+    def meta(self):
+        """
+            The channel the song was added in and the member who added it (when they can still be found),
+            plus anything else that was passed along when the entry was made.
+        """
+        meta = dict(self._extra_meta) if self._extra_meta else {}
+
+        channel = self.playlist.bot.get_channel(self.channel_id) if self.channel_id else None
+        if channel:
+            meta['channel'] = channel
+
+            author = channel.server.get_member(self.author_id) if self.author_id else None
+            if author:
+                meta['author'] = author
+
+        return meta
 
     @classmethod
     def from_json(cls, playlist, jsonstring):
-        data = json.loads(jsonstring)
-        print(data)
-        # TODO: version check
-        url = data['url']
-        title = data['title']
-        duration = data['duration']
-        downloaded = data['downloaded']
-        filename = data['filename'] if downloaded else None
-        meta = {}
-
-        # TODO: Better [name] fallbacks
-        if 'channel' in data['meta']:
-            ch = playlist.bot.get_channel(data['meta']['channel']['id'])
-            meta['channel'] = ch or data['meta']['channel']['name']
-
-        if 'author' in data['meta']:
-            meta['author'] = meta['channel'].server.get_member(data['meta']['author']['id'])
-
-        return cls(playlist, url, title, duration, filename, **meta)
+        return cls.from_dict(playlist, json.loads(jsonstring))
 
-    def to_json(self):
-        data = {
-            'version': 1,
-            'type': self.__class__.__name__,
+    @classmethod
+    def from_dict(cls, playlist, data):
+        """
+            Rebuilds an entry saved with `to_dict`.  Nothing is extracted again, the song is found in the cache
+            (or downloaded) once it comes close to playing, like any other entry.
+        """
+        entry = cls(playlist, data['url'], data['title'], data['duration'], data['expected_filename'])
+        entry.channel_id = data.get('channel')
+        entry.author_id = data.get('author')
+        return entry
+
+    def to_dict(self):
+        return {
             'url': self.url,
             'title': self.title,
             'duration': self.duration,
-            'downloaded': self.is_downloaded,
-            'filename': self.filename,
-            'meta': {
-                i: {
-                    'type': self.meta[i].__class__.__name__,
-                    'id': self.meta[i].id,
-                    'name': self.meta[i].name
-                    } for i in self.meta
-                }
-            # Actually I think I can just getattr instead, getattr(discord, type)
+            'expected_filename': self.expected_filename,
+            'channel': self.channel_id,
+            'author': self.author_id
         }
-        return json.dumps(data, indent=2)
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def _schedule_download(self, priority):
+        # Entries of the same song (on other servers, or queued twice) share one download.
+        self.playlist.downloader.scheduler.submit(self.url, self._download, priority, owner=self)
+
+    def cancel_prefetch(self):
+        if not self._waiting_futures:
+            self.playlist.downloader.scheduler.cancel(self.url, owner=self)
+
+    async def get_stream_info(self):
+        """
+            Resolves the url of the media itself, so it can be played before the download is done.
+            Returns the url and the http headers that have to be sent along with the request.
+        """
+        info = await self.playlist.downloader.extract_info(self.playlist.loop, self.url, download=False, use_cache=False)
+
+        if not info or not info.get('url'):
+            raise ExtractionError("Could not find a stream url for %s" % self.url)
+
+        return info['url'], info.get('http_headers', {})
 
     # noinspection PyTypeChecker
-    async def _download(self):
+    async def _download(self, cancel=None):
         if self._is_downloading:
             return
 
         self._is_downloading = True
         try:
+            fs = self.playlist.downloader.fs
+
             # Ensure the folder that we're going to move into exists.
-            if not os.path.exists(self.download_folder):
-                os.makedirs(self.download_folder)
+            await fs.makedirs(self.download_folder)
 
             # self.expected_filename: audio_cache\youtube-9R8aSKwTEMg-NOMA_-_Brain_Power.m4a
             extractor = os.path.basename(self.expected_filename).split('-')[0]
+            cache_index = self.playlist.downloader.cache_index
 
             # the generic extractor requires special handling
             if extractor == 'generic':
                 # print("Handling generic")
-                flistdir = [f.rsplit('-', 1)[0] for f in os.listdir(self.download_folder)]
                 expected_fname_noex, fname_ex = os.path.basename(self.expected_filename).rsplit('.', 1)
 
-                if expected_fname_noex in flistdir:
+                # Files from before the content store were named after the url with a piece of their hash.
+                cached = await cache_index.check(
+                    self.playlist.downloader.content_store.get(self.url) or cache_index.find_prefix(expected_fname_noex))
+
+                if cached:
                     try:
                         rsize = int(await get_header(self.playlist.bot.aiosession, self.url, 'CONTENT-LENGTH'))
                     except:
                         rsize = 0
 
-                    lfile = os.path.join(
-                        self.download_folder,
-                        os.listdir(self.download_folder)[flistdir.index(expected_fname_noex)]
-                    )
-
-                    # print("Resolved %s to %s" % (self.expected_filename, lfile))
-                    lsize = os.path.getsize(lfile)
-                    # print("Remote size: %s Local size: %s" % (rsize, lsize))
+                    # print("Resolved %s to %s" % (self.expected_filename, cached.path))
+                    # print("Remote size: %s Local size: %s" % (rsize, cached.size))
 
-                    if lsize != rsize:
-                        await self._really_download(hash=True)
+                    if cached.size != rsize:
+                        await self._download_generic(fname_ex, cancel=cancel)
                     else:
                         # print("[Download] Cached:", self.url)
-                        self.filename = lfile
+                        self.filename = cached.path
 
                 else:
                     # print("File not found in cache (%s)" % expected_fname_noex)
-                    await self._really_download(hash=True)
+                    await self._download_generic(fname_ex, cancel=cancel)
 
             else:
-                ldir = os.listdir(self.download_folder)
-                flistdir = [f.rsplit('.', 1)[0] for f in ldir]
                 expected_fname_base = os.path.basename(self.expected_filename)
                 expected_fname_noex = expected_fname_base.rsplit('.', 1)[0]
 
                 # idk wtf this is but its probably legacy code
                 # or i have youtube to blame for changing shit again
 
-                if expected_fname_base in ldir:
-                    self.filename = os.path.join(self.download_folder, expected_fname_base)
+                cached = await cache_index.check(cache_index.get(expected_fname_base))
+                similar = None if cached else await cache_index.check(cache_index.find_stem(expected_fname_noex))
+
+                if cached:
+                    self.filename = cached.path
                     print("[Download] Cached:", self.url)
 
-                elif expected_fname_noex in flistdir:
+                elif similar:
                     print("[Download] Cached (different extension):", self.url)
-                    self.filename = os.path.join(self.download_folder, ldir[flistdir.index(expected_fname_noex)])
+                    self.filename = similar.path
                     print("Expected %s, got %s" % (
                         self.expected_filename.rsplit('.', 1)[-1],
                         self.filename.rsplit('.', 1)[-1]
                     ))
 
                 else:
-                    await self._really_download()
+                    await self._really_download(cancel=cancel)
+
+            # Not waited for, the song can be played in the meantime.
+            asyncio.ensure_future(self.playlist.bot.process_download(self.filename))
 
             # Trigger ready callbacks.
             self._for_each_future(lambda future: future.set_result(self))
 
+        except DownloadPreempted:
+            # The scheduler will run us again later, leave the futures waiting until then.
+            print("[Download] Preempted:", self.url)
+            raise
+
         except Exception as e:
             traceback.print_exc()
             self._for_each_future(lambda future: future.set_exception(e))
@@ -205,12 +272,13 @@ class URLPlaylistEntry(BasePlaylistEntry):
         finally:
             self._is_downloading = False
 
-    # noinspection PyShadowingBuiltins
-    async def _really_download(self, *, hash=False):
+    async def _really_download(self, *, cancel=None):
         print("[Download] Started:", self.url)
 
         try:
-            result = await self.playlist.downloader.extract_info(self.playlist.loop, self.url, download=True)
+            result = await self.playlist.downloader.extract_info(self.playlist.loop, self.url, download=True, cancel=cancel)
+        except DownloadPreempted:
+            raise
         except Exception as e:
             raise ExtractionError(e)
 
@@ -220,18 +288,179 @@ class URLPlaylistEntry(BasePlaylistEntry):
             raise ExtractionError("ytdl broke and hell if I know why")
             # What the fuck do I do now?
 
-        self.filename = unhashed_fname = self.playlist.downloader.ytdl.prepare_filename(result)
+        self.filename = self.playlist.downloader.ytdl.prepare_filename(result)
+        await self.playlist.downloader.cache_index.add_async(self.filename)
 
-        if hash:
-            # insert the 8 last characters of the file hash to the file name to ensure uniqueness
-            self.filename = md5sum(unhashed_fname, 8).join('-.').join(unhashed_fname.rsplit('.', 1))
+    async def _download_generic(self, ext, *, cancel=None):
+        """
+            Downloads a direct link ourselves, hashing it on the way in, and puts it in the content store.
+        """
+        print("[Download] Started:", self.url)
 
-            if os.path.isfile(self.filename):
-                # Oh bother it was actually there.
-                os.unlink(unhashed_fname)
-            else:
-                # Move the temporary file to it's final location.
-                os.rename(unhashed_fname, self.filename)
+        fs = self.playlist.downloader.fs
+        media_url, headers = await self.get_stream_info()
+        fd, partial = await fs.run(tempfile.mkstemp, suffix='.part', dir=self.download_folder)
+
+        try:
+            writer = HashingWriter(os.fdopen(fd, 'wb'))
+
+            try:
+                async with self.playlist.bot.aiosession.get(media_url, headers=headers) as response:
+                    if response.status != 200:
+                        raise ExtractionError("Could not download %s (HTTP %s)" % (self.url, response.status))
+
+                    while True:
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadPreempted("Download of %s was preempted" % self.url)
+
+                        chunk = await response.content.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+
+                        await fs.run(writer.write, chunk)
+            finally:
+                await fs.run(writer.close)
+
+        except:
+            await fs.unlink(partial)
+            raise
+
+        self.filename = await self.playlist.downloader.content_store.add(self.url, partial, writer.hexdigest(), ext)
+        print("[Download] Complete:", self.url)
+
+
+class LazyPlaylistEntry(URLPlaylistEntry):
+    """
+        An entry made from a flat playlist listing, which only has the url and title of every song.  The rest
+        is looked up once the entry comes close to playing (see `resolve`), so a big playlist is queued right away.
+
+        Songs that turn out to be longer than `max_duration` seconds drop out of the queue when they're resolved.
+    """
+
+    __slots__ = ('max_duration', '_resolving')
+
+    def __init__(self, playlist, url, title, duration=0, expected_filename=None, *, max_duration=0, **meta):
+        super().__init__(playlist, url, title, duration, expected_filename, **meta)
+
+        self.max_duration = max_duration
+        self._resolving = None
+
+    @property
+    def resolved(self):
+        return self.expected_filename is not None
+
+    async def resolve(self):
+        """
+            Looks the song up, filling in its duration and file name.  Callers waiting at the same time share the lookup.
+        """
+        if self.resolved:
+            return
+
+        if self._resolving is None:
+            self._resolving = asyncio.ensure_future(self._resolve(), loop=self.playlist.loop)
+            self._resolving.add_done_callback(self._resolved)
+
+        await asyncio.shield(self._resolving)
+
+    def _resolved(self, future):
+        self._resolving = None
+
+    @classmethod
+    def from_dict(cls, playlist, data):
+        entry = super().from_dict(playlist, data)
+        entry.max_duration = data.get('max_duration') or 0
+        return entry
+
+    def to_dict(self):
+        data = super().to_dict()
+        data['max_duration'] = self.max_duration
+        return data
+
+    async def _resolve(self):
+        playlist = self.playlist
+
+        try:
+            info = await playlist.downloader.extract_info(playlist.loop, self.url, download=False)
+        except Exception as e:
+            raise ExtractionError('Could not extract information from {}\n\n{}'.format(self.url, e))
+
+        if not info:
+            raise ExtractionError('Could not extract information from %s' % self.url)
+
+        self.title = info.get('title', self.title)
+        self.duration = info.get('duration', 0) or 0
+
+        if self in playlist.entries:
+            playlist.entries.reweigh(self)
+
+        if self.max_duration and self.duration > self.max_duration:
+            if self in playlist.entries:
+                playlist.remove_entry(self)
+
+            raise ExtractionError('%s is longer than %s seconds, dropped it' % (self.title, self.max_duration))
+
+        self.expected_filename = playlist.downloader.ytdl.prepare_filename(info)
+
+    async def get_stream_info(self):
+        await self.resolve()
+        return await super().get_stream_info()
+
+    async def _download(self, cancel=None):
+        try:
+            await self.resolve()
+
+        except Exception as e:
+            print("[Download] Could not resolve %s: %s" % (self.url, e))
+            self._for_each_future(lambda future: future.set_exception(e))
+            return
+
+        await super()._download(cancel=cancel)
+
+
+def benchmark(count=10000):
+    """
+        Measures the memory `count` entries take, next to the same entries stored the way they used to be:
+        a __dict__ each, with a meta dict holding the discord objects and a list for the futures.
+        The urls, titles and file names are the same for both and aren't counted.
+    """
+    import tracemalloc
+
+    class DictEntry:
+        def __init__(self, playlist, url, title, duration=0, expected_filename=None, **meta):
+            self.filename = None
+            self._is_downloading = False
+            self._waiting_futures = []
+            self.playlist = playlist
+            self.url = url
+            self.title = title
+            self.duration = duration
+            self.expected_filename = expected_filename
+            self.meta = meta
+            self.download_folder = self.playlist.downloader.download_folder
+
+    class Stub:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    playlist = Stub(downloader=Stub(download_folder='audio_cache'))
+    channel = Stub(id='1' * 18)
+    author = Stub(id='2' * 18)
+    songs = [('https://www.youtube.com/watch?v=%011d' % n, 'Song %s' % n, 'audio_cache/youtube-%011d-Song_%s.m4a' % (n, n))
+             for n in range(count)]
+
+    for entry_type in (DictEntry, URLPlaylistEntry):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        entries = [entry_type(playlist, url, title, 200, filename, channel=channel, author=author)
+                   for url, title, filename in songs]
+
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del entries
 
+        print('%-17s %s bytes per entry' % (entry_type.__name__, used // count))
 
 
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:]))
@@ -30,6 +30,10 @@ class WrongEntryTypeError(ExtractionError):
         self.is_playlist = is_playlist
         self.use_url = use_url
 
+# A download was stopped to make room for a more important one, it will be retried later
+class DownloadPreempted(ExtractionError):
+    pass
+
 # The user doesn't have permission to use a command
 class PermissionsError(CommandError):
     @property
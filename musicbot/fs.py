@@ -0,0 +1,50 @@
+import os
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileSystem:
+    """
+        Runs blocking filesystem calls in threads of their own, so a slow disk doesn't hold up the event loop.
+
+        The pool is kept apart from the download threads, otherwise deleting a file could end up waiting
+        behind a couple of downloads.
+    """
+
+    def __init__(self, loop=None, *, workers=2):
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.calls = 0
+
+    def run(self, func, *args, **kwargs):
+        """
+            Runs `func(*args, **kwargs)` in the filesystem threads.  Returns a future with the result.
+        """
+        self.calls += 1
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def exists(self, path):
+        return self.run(os.path.exists, path)
+
+    def isfile(self, path):
+        return self.run(os.path.isfile, path)
+
+    def stat(self, path):
+        return self.run(os.stat, path)
+
+    def listdir(self, path):
+        return self.run(os.listdir, path)
+
+    def makedirs(self, path, exist_ok=True):
+        return self.run(os.makedirs, path, exist_ok=exist_ok)
+
+    def unlink(self, path):
+        return self.run(os.unlink, path)
+
+    def replace(self, src, dst):
+        return self.run(os.replace, src, dst)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,170 @@
+"""
+    Gain stages apply the volume to the s16le stereo pcm frames coming out of ffmpeg.
+
+    NumPy is used when it's installed, otherwise audioop (which is gone since python 3.13), with a slow pure
+    python version as the last resort.  Run this module to compare the speed of the available backends.
+"""
+
+import sys
+import time
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+MAX_GAIN = 2.0
+SAMPLE_WIDTH = 2
+CHANNELS = 2
+RAMP_STEPS = 8  # the number of pieces a frame is split into when ramping with audioop
+
+
+class GainStage:
+    """
+        Scales frames by a gain.  When the gain is changed, the next frame is ramped from the old gain to
+        the new one instead of jumping straight to it, which would make an audible click.
+    """
+
+    name = 'python'
+
+    def __init__(self, gain=1.0):
+        self._gain = self.target = min(max(gain, 0.0), MAX_GAIN)
+
+    def set_gain(self, gain, *, ramp=True):
+        self.target = min(max(gain, 0.0), MAX_GAIN)
+
+        if not ramp:
+            self._gain = self.target
+
+    def process(self, frame):
+        start = self._gain
+        self._gain = end = self.target
+
+        if start != end:
+            return self._ramp(frame, start, end)
+
+        if end == 1.0:
+            return frame
+
+        return self._scale(frame, end)
+
+    def _scale(self, frame, gain):
+        samples = array('h', frame)
+
+        for i in range(len(samples)):
+            samples[i] = max(-32768, min(32767, int(samples[i] * gain)))
+
+        return samples.tobytes()
+
+    def _ramp(self, frame, start, end):
+        samples = array('h', frame)
+        step = (end - start) / max(1, len(samples) // CHANNELS)
+
+        for i in range(len(samples)):
+            gain = start + step * (i // CHANNELS)
+            samples[i] = max(-32768, min(32767, int(samples[i] * gain)))
+
+        return samples.tobytes()
+
+
+class AudioopGainStage(GainStage):
+    name = 'audioop'
+
+    def _scale(self, frame, gain):
+        return audioop.mul(frame, SAMPLE_WIDTH, gain)
+
+    def _ramp(self, frame, start, end):
+        if not frame:
+            # The end of the song, nothing to ramp.
+            return frame
+
+        # audioop can only do one gain per call, so the ramp is done in a few steps of at least one sample each.
+        sample = SAMPLE_WIDTH * CHANNELS
+        chunk = max(1, -(-len(frame) // RAMP_STEPS // sample)) * sample
+        steps = -(-len(frame) // chunk)
+        step = (end - start) / steps
+
+        return b''.join(
+            audioop.mul(frame[i:i + chunk], SAMPLE_WIDTH, start + step * (n + 1))
+            for n, i in enumerate(range(0, len(frame), chunk)))
+
+
+class NumpyGainStage(GainStage):
+    name = 'numpy'
+
+    def _scale(self, frame, gain):
+        samples = numpy.frombuffer(frame, dtype=numpy.int16).astype(numpy.float32)
+        samples *= gain
+        return numpy.clip(samples, -32768, 32767, out=samples).astype(numpy.int16).tobytes()
+
+    def _ramp(self, frame, start, end):
+        samples = numpy.frombuffer(frame, dtype=numpy.int16).astype(numpy.float32)
+        samples *= numpy.linspace(start, end, len(samples) // CHANNELS, dtype=numpy.float32).repeat(CHANNELS)
+        return numpy.clip(samples, -32768, 32767, out=samples).astype(numpy.int16).tobytes()
+
+
+BACKENDS = [GainStage]
+
+if audioop:
+    BACKENDS.insert(0, AudioopGainStage)
+
+if numpy:
+    BACKENDS.insert(0, NumpyGainStage)
+
+
+def best_gain_stage(gain=1.0):
+    """
+        Returns a gain stage using the fastest backend that's available.
+    """
+    return BACKENDS[0](gain)
+
+
+def rms(frame):
+    """
+        Returns the root mean square of a s16le frame.
+    """
+    if numpy:
+        samples = numpy.frombuffer(frame, dtype=numpy.int16).astype(numpy.float32)
+        return int(numpy.sqrt(numpy.mean(samples * samples))) if len(samples) else 0
+
+    if audioop:
+        return audioop.rms(frame, SAMPLE_WIDTH)
+
+    samples = array('h', frame)
+    return int((sum(s * s for s in samples) / len(samples)) ** 0.5) if samples else 0
+
+
+def benchmark(frames=500, frame_size=3840):
+    """
+        Times each available backend on `frames` frames of noise, at unity gain, at a fixed gain and while
+        ramping between gains.  The default frame size is 20ms of 48KHz stereo audio.
+    """
+    import os
+
+    data = [os.urandom(frame_size) for _ in range(frames)]
+
+    for backend in BACKENDS:
+        results = []
+
+        for label, gains in (('unity', (1.0, 1.0)), ('fixed', (0.15, 0.15)), ('ramp', (0.15, 0.6))):
+            stage = backend(gains[0])
+            t0 = time.perf_counter()
+
+            for n, frame in enumerate(data):
+                stage.set_gain(gains[n % 2])
+                stage.process(frame)
+
+            results.append('%s %.1fus' % (label, (time.perf_counter() - t0) / frames * 1e6))
+
+        print('%-8s %s  (per frame)' % (backend.name, ', '.join(results)))
+
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:]))
@@ -0,0 +1,296 @@
+import random
+
+
+class _Node:
+    __slots__ = ('item', 'weight', 'priority', 'left', 'right', 'parent', 'size', 'total')
+
+    def __init__(self, item, weight):
+        self.item = item
+        self.weight = weight
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.parent = None
+        self.size = 1
+        self.total = weight
+
+
+def _size(node):
+    return node.size if node else 0
+
+
+def _total(node):
+    return node.total if node else 0
+
+
+def _update(node):
+    left, right = node.left, node.right
+    node.size = 1 + _size(left) + _size(right)
+    node.total = node.weight + _total(left) + _total(right)
+
+    if left:
+        left.parent = node
+    if right:
+        right.parent = node
+
+
+def _merge(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+
+def _split(node, k):
+    """
+        Splits off the first `k` items.  Returns the roots of both halves.
+    """
+    if not node:
+        return None, None
+
+    if _size(node.left) < k:
+        left, right = _split(node.right, k - _size(node.left) - 1)
+        node.right = left
+        _update(node)
+        if right:
+            right.parent = None
+        return node, right
+
+    left, right = _split(node.left, k)
+    node.left = right
+    _update(node)
+    if left:
+        left.parent = None
+    return left, node
+
+
+def _build(nodes):
+    """
+        Builds a treap out of `nodes` in the order they're in, in linear time.
+    """
+    stack = []
+
+    for node in nodes:
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+
+    if not stack:
+        return None
+
+    # Sizes and totals have to be worked out bottom up, children before their parents.
+    order = []
+    pending = [stack[0]]
+    while pending:
+        node = pending.pop()
+        order.append(node)
+        pending.extend(child for child in (node.left, node.right) if child)
+
+    for node in reversed(order):
+        _update(node)
+
+    stack[0].parent = None
+    return stack[0]
+
+
+class IndexedSequence:
+    """
+        A sequence that works like a deque, but also knows the position of every item and the total `weight` of
+        any number of items at the front.  Those take O(log n), as do adding and removing items anywhere.
+
+        It's a treap ordered by position, every node keeps the size and total weight of its subtree.  Items have
+        to be hashable and can only be in the sequence once.
+    """
+
+    def __init__(self, iterable=(), weight=None):
+        self._weight = weight or (lambda item: 0)
+        self._root = None
+        self._nodes = {}  # item -> node
+
+        self.extend(iterable)
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __bool__(self):
+        return self._root is not None
+
+    def __contains__(self, item):
+        return item in self._nodes
+
+    def __iter__(self):
+        stack = []
+        node = self._root
+
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+
+            node = stack.pop()
+            yield node.item
+            node = node.right
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def __getitem__(self, index):
+        return self._node_at(index).item
+
+    def __delitem__(self, index):
+        self._delete_at(self._normalize(index))
+
+    def _normalize(self, index):
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('%s index out of range' % self.__class__.__name__)
+
+        return index
+
+    def _node_at(self, index):
+        index = self._normalize(index)
+        node = self._root
+
+        while True:
+            left = _size(node.left)
+
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node
+            else:
+                index -= left + 1
+                node = node.right
+
+    def _new_node(self, item):
+        if item in self._nodes:
+            raise ValueError('%r is already in the sequence' % (item,))
+
+        node = self._nodes[item] = _Node(item, self._weight(item))
+        return node
+
+    def _set_root(self, root):
+        self._root = root
+        if root:
+            root.parent = None
+
+    def _delete_at(self, index):
+        left, right = _split(self._root, index)
+        node, right = _split(right, 1)
+        self._set_root(_merge(left, right))
+
+        del self._nodes[node.item]
+        return node.item
+
+    def append(self, item):
+        self._set_root(_merge(self._root, self._new_node(item)))
+
+    def appendleft(self, item):
+        self._set_root(_merge(self._new_node(item), self._root))
+
+    def insert(self, index, item):
+        index = min(max(0, index + len(self) if index < 0 else index), len(self))
+        node = self._new_node(item)
+
+        left, right = _split(self._root, index)
+        self._set_root(_merge(_merge(left, node), right))
+
+    def extend(self, iterable):
+        nodes = []
+
+        try:
+            for item in iterable:
+                nodes.append(self._new_node(item))
+
+        except ValueError:
+            for node in nodes:
+                del self._nodes[node.item]
+            raise
+
+        self._set_root(_merge(self._root, _build(nodes)))
+
+    def pop(self):
+        if not self._root:
+            raise IndexError('pop from an empty %s' % self.__class__.__name__)
+
+        return self._delete_at(len(self) - 1)
+
+    def popleft(self):
+        if not self._root:
+            raise IndexError('pop from an empty %s' % self.__class__.__name__)
+
+        return self._delete_at(0)
+
+    def remove(self, item):
+        self._delete_at(self.index(item))
+
+    def clear(self):
+        self._root = None
+        self._nodes.clear()
+
+    def index(self, item):
+        """
+            The position of `item`, found by walking up from its node instead of searching the whole sequence.
+        """
+        try:
+            node = self._nodes[item]
+        except KeyError:
+            raise ValueError('%r is not in the sequence' % (item,))
+
+        index = _size(node.left)
+
+        while node.parent:
+            if node is node.parent.right:
+                index += _size(node.parent.left) + 1
+            node = node.parent
+
+        return index
+
+    def total(self):
+        return _total(self._root)
+
+    def weight_before(self, index):
+        """
+            The total weight of the first `index` items.
+        """
+        total = 0
+        node = self._root
+
+        while node and index > 0:
+            left = _size(node.left)
+
+            if index <= left:
+                node = node.left
+            else:
+                total += _total(node.left) + node.weight
+                index -= left + 1
+                node = node.right
+
+        return total
+
+    def reweigh(self, item):
+        """
+            Picks up a change in the weight of `item`.
+        """
+        node = self._nodes[item]
+        node.weight = self._weight(item)
+
+        while node:
+            node.total = node.weight + _total(node.left) + _total(node.right)
+            node = node.parent
@@ -0,0 +1,84 @@
+import re
+import asyncio
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .gain import MAX_GAIN
+
+# Track gain is kept within these limits, whatever the analysis says.  The gain stage won't go over MAX_GAIN,
+# so more than that would only be cut off there.
+MIN_TRACK_GAIN = 0.1        # -20 dB
+MAX_TRACK_GAIN = MAX_GAIN   # +6 dB
+
+# What ffmpeg's ebur128 filter reports for silence.
+SILENCE = -70.0
+
+_integrated_re = re.compile(r'I:\s+(-?[\d.]+) LUFS')
+_peak_re = re.compile(r'Peak:\s+(-?[\d.]+|-inf) dBFS')
+
+
+class LoudnessAnalyzer:
+    """
+        Measures how loud songs are (EBU R128 integrated loudness, like ReplayGain 2) with ffmpeg's ebur128
+        filter, and works out the gain that brings them to `target` LUFS.  This is done once after the download,
+        playing the song then only costs a multiplication in the gain stage that's already there.
+    """
+
+    def __init__(self, *, target=-18.0, workers=1):
+        self.target = target
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.analyzed = 0
+        self.failed = 0
+
+    @staticmethod
+    def parse(output):
+        """
+            Returns the integrated loudness and true peak from the summary ebur128 prints at the end.
+        """
+        integrated = _integrated_re.findall(output)
+        peak = _peak_re.findall(output)
+
+        if not integrated:
+            raise ValueError("No loudness summary in the ffmpeg output")
+
+        return float(integrated[-1]), float(peak[-1]) if peak else None
+
+    def _run_ffmpeg(self, filename):
+        return subprocess.run([
+            'ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-i', filename, '-vn',
+            '-af', 'ebur128=peak=true', '-f', 'null', '-'
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    async def analyze(self, filename):
+        """
+            Returns (loudness in LUFS, true peak in dBFS) of `filename`, or None if ffmpeg couldn't do it.
+        """
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(self.executor, self._run_ffmpeg, filename)
+            loudness, peak = self.parse(result.stderr.decode('utf8', 'replace'))
+
+        except Exception as e:
+            print("[Loudness] Could not analyze %s: %s" % (filename, e))
+            self.failed += 1
+            return None
+
+        self.analyzed += 1
+        return loudness, peak
+
+    def gain_for(self, loudness, peak=None):
+        """
+            The gain that brings a song measured at `loudness` to the target, without pushing its peak over 0 dBFS.
+        """
+        if loudness is None or loudness <= SILENCE:
+            return 1.0
+
+        gain = 10 ** ((self.target - loudness) / 20)
+
+        if peak is not None:
+            gain = min(gain, 10 ** (-peak / 20))
+
+        return min(max(gain, MIN_TRACK_GAIN), MAX_TRACK_GAIN)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
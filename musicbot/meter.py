@@ -0,0 +1,128 @@
+import math
+import time
+import asyncio
+import traceback
+
+from collections import deque
+from shutil import get_terminal_size
+
+from .gain import rms
+
+
+class LevelMeter:
+    """
+        Keeps track of how loud the audio going out is, without slowing down the voice thread.
+
+        The voice thread only hands over each frame with `feed`, which is a single deque append.  The frames
+        are picked up by `run` on the event loop, where the rms is worked out and (optionally) drawn on the
+        console.  If we fall behind, the oldest frames are simply dropped from the ring buffer.
+
+        Nothing is measured unless the levels are drawn, or someone asked for them in the last `linger` seconds
+        (see `activate`).
+    """
+
+    def __init__(self, *, window=90, buffer=50, interval=0.1, frame_skip=2, draw=False, linger=60):
+        self.frames = deque(maxlen=buffer)  # deque appends and pops are atomic, no lock needed
+        self.levels = deque(maxlen=window)
+        self.interval = interval
+        self.frame_skip = frame_skip
+        self.draw = draw
+        self.linger = linger
+        self.active = draw  # read by the voice thread, only ever set on the event loop
+
+        self._active_until = 0
+        self._fed = 0
+        self.measured = 0
+
+    def feed(self, frame):
+        """
+            Called from the voice thread for every frame sent.
+        """
+        if not self.active:
+            return
+
+        self._fed += 1
+
+        if not self._fed % self.frame_skip:
+            self.frames.append(frame)
+
+    def activate(self):
+        """
+            Starts measuring, or keeps it going, for the next `linger` seconds.
+        """
+        self._active_until = time.monotonic() + self.linger
+        self.active = True
+
+    def _update_active(self):
+        active = self.draw or time.monotonic() < self._active_until
+
+        if self.active and not active:
+            self.reset()
+
+        self.active = active
+
+    def reset(self):
+        self.frames.clear()
+        self.levels.clear()
+
+    def _consume(self):
+        while True:
+            try:
+                frame = self.frames.popleft()
+            except IndexError:
+                break
+
+            self.levels.append(rms(frame))
+            self.measured += 1
+
+    @property
+    def current(self):
+        return self.levels[-1] if self.levels else 0
+
+    @property
+    def average(self):
+        return sum(self.levels) / len(self.levels) if self.levels else 0
+
+    @property
+    def peak(self):
+        return max(self.levels) if self.levels else 0
+
+    @staticmethod
+    def to_dbfs(level):
+        return 20 * math.log10(level / 32768) if level > 0 else float('-inf')
+
+    def bar(self, width=30, *, char='#'):
+        """
+            Returns the current level relative to the recent peak as a bar of `width` characters.
+        """
+        filled = int(width * self.current / max(1, self.peak))
+        return char * filled + '-' * (width - filled)
+
+    def _print(self):
+        text = 'avg rms: {:.2f}, max rms: {:.2f} '.format(self.average, self.peak)
+        tx = get_terminal_size().columns
+        print((text + self.bar(max(0, tx - len(text) - 1))).ljust(tx - 1), end='\r')
+
+    def clear_line(self):
+        if self.draw:
+            print(' ' * (get_terminal_size().columns - 1), end='\r')
+
+    async def run(self, player):
+        """
+            Keeps measuring for as long as `player` lives.
+        """
+        while not player.is_dead:
+            try:
+                self._update_active()
+
+                if self.active:
+                    self._consume()
+
+                if self.draw and player.is_playing and self.levels:
+                    self._print()
+            except:
+                traceback.print_exc()
+            finally:
+                await asyncio.sleep(self.interval)
+
+        self.clear_line()
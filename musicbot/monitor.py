@@ -0,0 +1,39 @@
+import asyncio
+
+from collections import deque
+
+
+class LoopMonitor:
+    """
+        Measures how late the event loop wakes us up.  Anything blocking the loop (like file access on a slow
+        disk) shows up as lag here, and every other server has to wait that long for the bot to respond.
+    """
+
+    def __init__(self, loop=None, *, interval=0.25, window=240, stall_threshold=0.1):
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+
+        self.samples = deque(maxlen=window)  # the last `window` lags in seconds, a minute by default
+        self.worst = 0.0
+        self.stalls = 0
+
+    @property
+    def average(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def recent_max(self):
+        return max(self.samples) if self.samples else 0.0
+
+    async def run(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.loop.time() - start - self.interval)
+
+            self.samples.append(lag)
+            self.worst = max(self.worst, lag)
+
+            if lag >= self.stall_threshold:
+                self.stalls += 1
@@ -0,0 +1,227 @@
+import os
+import time
+import asyncio
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from discord.voice_client import StreamPlayer
+
+OPUS_FOLDER = 'opus'
+
+# Every packet is 20ms of 48KHz stereo, which would have been this many bytes of pcm.
+PACKET_PCM_BYTES = 3840
+
+
+def read_opus_packets(file):
+    """
+        Yields the opus packets in an ogg file, skipping the OpusHead and OpusTags header packets.
+    """
+    packet = b''
+
+    while True:
+        header = file.read(27)
+        if len(header) < 27:
+            return
+
+        if header[:4] != b'OggS':
+            raise ValueError("Not an ogg page at offset %s" % (file.tell() - 27))
+
+        # Packets are split up in segments of 255 bytes, a shorter segment ends the packet.
+        segments = file.read(header[26])
+        data = file.read(sum(segments))
+        offset = 0
+
+        for length in segments:
+            packet += data[offset:offset + length]
+            offset += length
+
+            if length < 255:
+                if not packet.startswith((b'OpusHead', b'OpusTags')):
+                    yield packet
+                packet = b''
+
+
+class OpusBuff:
+    """
+        Hands out the packets of a pre-encoded song.  Quacks enough like PatchedBuff for the MusicPlayer.
+        The volume can't be changed, it was baked in when the song was encoded.
+    """
+
+    def __init__(self, filename, gain):
+        self.filename = filename
+        self.gain = gain
+        self.frame_count = 0
+        self.bytes_read = 0
+        self.meter = None
+
+        self._file = None
+        self._packets = None
+
+    @property
+    def volume(self):
+        return self.gain
+
+    @volume.setter
+    def volume(self, value):
+        pass
+
+    def read(self):
+        if self._packets is None:
+            self._file = open(self.filename, 'rb')
+            self._packets = read_opus_packets(self._file)
+
+        packet = next(self._packets, None)
+
+        if packet is not None:
+            self.frame_count += 1
+            self.bytes_read += PACKET_PCM_BYTES
+
+        return packet
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class OpusPlayer(StreamPlayer):
+    """
+        Sends pre-encoded opus packets straight to discord.  No ffmpeg and no encoding, the voice thread
+        only has to read the file.  Timing, pausing and reconnecting work the same as discord's StreamPlayer.
+    """
+
+    def __init__(self, filename, gain, voice_client, after):
+        self.process = None
+        super().__init__(OpusBuff(filename, gain), voice_client.encoder, voice_client._connected,
+                         voice_client.play_audio, after)
+
+    def run(self):
+        self.loops = 0
+        self._start = time.time()
+
+        try:
+            while not self._end.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+
+                if not self._connected.is_set():
+                    self._connected.wait()
+                    self.loops = 0
+                    self._start = time.time()
+
+                if self._end.is_set():
+                    break
+
+                self.loops += 1
+                packet = self.buff.read()
+
+                if packet is None:
+                    self.stop()
+                    break
+
+                self.player(packet, encode=False)
+
+                next_time = self._start + self.delay * self.loops
+                time.sleep(max(0, self.delay + (next_time - time.time())))
+
+        except Exception as e:
+            self._current_error = e
+            self.stop()
+
+        finally:
+            self.buff.close()
+
+    def stop(self):
+        super().stop()
+
+        # Wake the thread up if it's paused, so it can finish.
+        self._resumed.set()
+
+
+class OpusCache:
+    """
+        Keeps an opus encoded copy of downloaded songs, at a fixed gain, in the opus folder next to them.
+        While a song plays at that gain, the MusicPlayer can send the copy without decoding and re-encoding.
+    """
+
+    def __init__(self, fs, *, gain, bitrate=128, workers=1):
+        self.fs = fs
+        self.gain = gain
+        self.bitrate = bitrate
+        self.executor = ThreadPoolExecutor(max_workers=workers)  # ffmpeg eats cpu, don't run too many
+        self.transcoded = 0
+        self.failed = 0
+        self._pending = set()
+
+    def matches(self, volume):
+        return int(round(volume * 100)) == int(round(self.gain * 100))
+
+    def path_for(self, filename, track_gain=1.0):
+        folder, name = os.path.split(filename)
+        return os.path.join(folder, OPUS_FOLDER, '%s.%s.opus' % (name, int(round(self.gain * track_gain * 100))))
+
+    async def find(self, filename, track_gain=1.0):
+        """
+            Returns the opus copy of `filename` if there is one.  `track_gain` is applied on top of the cache's gain.
+        """
+        path = self.path_for(filename, track_gain)
+        return path if await self.fs.isfile(path) else None
+
+    def _run_ffmpeg(self, filename, target, gain):
+        return subprocess.run([
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', filename, '-vn',
+            '-af', 'volume=%s' % gain, '-ar', '48000', '-ac', '2',
+            '-c:a', 'libopus', '-b:a', '%sk' % self.bitrate, '-frame_duration', '20', '-application', 'audio',
+            '-f', 'ogg', target
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    async def transcode(self, filename, track_gain=1.0):
+        """
+            Makes the opus copy of `filename`, unless it's already there.  Returns its path, or None if it failed.
+        """
+        target = self.path_for(filename, track_gain)
+
+        if target in self._pending:
+            return None
+
+        if await self.fs.isfile(target):
+            return target
+
+        self._pending.add(target)
+        partial = target + '.part'
+
+        try:
+            await self.fs.makedirs(os.path.dirname(target))
+            result = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._run_ffmpeg, filename, partial, self.gain * track_gain)
+
+            if result.returncode:
+                raise OSError(result.stderr.decode('utf8', 'replace').strip() or 'ffmpeg exited with %s' % result.returncode)
+
+            await self.fs.replace(partial, target)
+
+        except Exception as e:
+            print("[Opus] Could not encode %s: %s" % (os.path.basename(filename), e))
+            self.failed += 1
+
+            try:
+                await self.fs.unlink(partial)
+            except OSError:
+                pass
+
+            return None
+
+        finally:
+            self._pending.discard(target)
+
+        self.transcoded += 1
+        return target
+
+    async def discard(self, filename, track_gain=1.0):
+        try:
+            await self.fs.unlink(self.path_for(filename, track_gain))
+        except OSError:
+            pass
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
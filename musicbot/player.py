@@ -1,14 +1,22 @@
 import os
+import shlex
 import asyncio
-import audioop
 import traceback
 
 from enum import Enum
-from array import array
-from collections import deque
-from shutil import get_terminal_size
+from discord.voice_client import ProcessPlayer
 
+from .gain import best_gain_stage
 from .lib.event_emitter import EventEmitter
+from .meter import LevelMeter
+from .opus import OpusPlayer
+from .scheduler import DownloadPriority
+
+# How long before the end of a song the next one is spawned when gapless playback is enabled.
+GAPLESS_PRIME_SECONDS = 5
+
+# ffmpeg hands us 48KHz 16 bit stereo pcm, so this many bytes make up a second of audio.
+PCM_BYTES_PER_SECOND = 48000 * 2 * 2
 
 
 class PatchedBuff:
@@ -16,63 +24,45 @@ class PatchedBuff:
         PatchedBuff monkey patches a readable object, allowing you to vary what the volume is as the song is playing.
     """
 
-    def __init__(self, buff, *, draw=False):
+    def __init__(self, buff, *, meter=None):
         self.buff = buff
         self.frame_count = 0
-        self.volume = 1.0
+        self.bytes_read = 0
+        self.gain = best_gain_stage()
+        self.meter = meter
+        self._primed_frame = None
+
+    @property
+    def volume(self):
+        return self.gain.target
 
-        self.draw = draw
-        self.use_audioop = True
-        self.frame_skip = 2
-        self.rmss = deque([2048], maxlen=90)
+    @volume.setter
+    def volume(self, value):
+        # Only ramp once we're playing, the volume set before the first frame should apply right away.
+        self.gain.set_gain(value, ramp=self.frame_count > 0)
 
-    def __del__(self):
-        if self.draw:
-            print(' ' * (get_terminal_size().columns-1), end='\r')
+    def prime(self, frame_size):
+        """
+            Reads the first frame ahead of time, so the decoder is up and running by the time playback starts.
+        """
+        self._primed_frame = self.buff.read(frame_size)
 
     def read(self, frame_size):
         self.frame_count += 1
 
-        frame = self.buff.read(frame_size)
-
-        if self.volume != 1:
-            frame = self._frame_vol(frame, self.volume, maxv=2)
-
-        if self.draw and not self.frame_count % self.frame_skip:
-            # these should be processed for every frame, but "overhead"
-            rms = audioop.rms(frame, 2)
-            self.rmss.append(rms)
-
-            max_rms = sorted(self.rmss)[-1]
-            meter_text = 'avg rms: {:.2f}, max rms: {:.2f} '.format(self._avg(self.rmss), max_rms)
-            self._pprint_meter(rms / max(1, max_rms), text=meter_text, shift=True)
-
-        return frame
-
-    def _frame_vol(self, frame, mult, *, maxv=2, use_audioop=True):
-        if use_audioop:
-            return audioop.mul(frame, 2, min(mult, maxv))
+        if self._primed_frame is None:
+            frame = self.buff.read(frame_size)
         else:
-            # ffmpeg returns s16le pcm frames.
-            frame_array = array('h', frame)
+            frame, self._primed_frame = self._primed_frame, None
 
-            for i in range(len(frame_array)):
-                frame_array[i] = int(frame_array[i] * min(mult, min(1, maxv)))
+        self.bytes_read += len(frame)
+        frame = self.gain.process(frame)
 
-            return frame_array.tobytes()
-
-    def _avg(self, i):
-        return sum(i) / len(i)
-
-    def _pprint_meter(self, perc, *, char='#', text='', shift=True):
-        tx, ty = get_terminal_size()
-
-        if shift:
-            outstr = text + "{}".format(char * (int((tx - len(text)) * perc) - 1))
-        else:
-            outstr = text + "{}".format(char * (int(tx * perc) - 1))[len(text):]
+        if self.meter:
+            # The meter does its work on the event loop, all we do here is hand over the frame.
+            self.meter.feed(frame)
 
-        print(outstr.ljust(tx - 1), end='\r')
+        return frame
 
 
 class MusicPlayerState(Enum):
@@ -99,9 +89,20 @@ class MusicPlayer(EventEmitter):
         self._play_lock = asyncio.Lock()
         self._current_player = None
         self._current_entry = None
+        self._source = None  # (source, before_options) ffmpeg was started with for the current entry
+        self._resume = None  # (entry, position) to start somewhere into the song instead of at the start
+        self._streaming = False
+        self._position_offset = 0  # where in the song the current player started, in seconds
+        self._track_gain = 1.0  # evens out the loudness of the current song, see LoudnessAnalyzer
+        self._primed = None  # (entry, player) of the next song when playing gapless
         self.state = MusicPlayerState.STOPPED
+        self.meter = LevelMeter()
 
         self.loop.create_task(self.websocket_check())
+        self.loop.create_task(self.meter.run(self))
+
+        if bot.config.gapless_playback:
+            self.loop.create_task(self.gapless_check())
 
     @property
     def volume(self):
@@ -111,7 +112,19 @@ class MusicPlayer(EventEmitter):
     def volume(self, value):
         self._volume = value
         if self._current_player:
-            self._current_player.buff.volume = value
+            if isinstance(self._current_player, OpusPlayer) and not self.bot.opus_cache.matches(value):
+                self._restart_at(self.position)
+            else:
+                self._current_player.buff.volume = value * self._track_gain
+
+    def update_track_gain(self):
+        """
+            Picks up the loudness of the current song, for when it was measured after the song started.
+        """
+        self._track_gain = self.bot.track_gain(self.current_entry.filename if self.current_entry else None)
+
+        if self._current_player and not isinstance(self._current_player, OpusPlayer):
+            self._current_player.buff.volume = self.volume * self._track_gain
 
     def on_entry_added(self, playlist, entry):
         if self.is_stopped:
@@ -123,6 +136,7 @@ class MusicPlayer(EventEmitter):
     def stop(self):
         self.state = MusicPlayerState.STOPPED
         self._kill_current_player()
+        self._discard_primed()
 
         self.emit('stop', player=self)
 
@@ -160,20 +174,32 @@ class MusicPlayer(EventEmitter):
         self.playlist.clear()
         self._events.clear()
         self._kill_current_player()
+        self._discard_primed()
 
     def _playback_finished(self):
         entry = self._current_entry
 
         if self._current_player:
+            # A stream that ended without producing anything never worked, play the downloaded file instead.
+            # (When skipped, the player is already gone by the time we get here.)
+            if self._streaming and self._current_player.buff.frame_count <= 1 and not self.is_dead:
+                print("[Stream] Nothing came out of the stream for %s, downloading it instead" % entry.url)
+                self._current_player.after = None
+                self._kill_current_player()
+                self.loop.create_task(self._play_downloaded(entry))
+                return
+
             self._current_player.after = None
             self._kill_current_player()
 
         self._current_entry = None
+        self._position_offset = 0
 
-        if not self.is_stopped and not self.is_dead:
+        if not self.is_stopped and not self.is_dead and not self._start_primed():
             self.play(_continue=True)
 
-        if not self.bot.config.save_videos and entry:
+        # With a cache budget the cache manager decides what gets deleted.
+        if not self.bot.config.save_videos and not self.bot.config.cache_budget and entry and entry.filename:
             if any([entry.filename == e.filename for e in self.playlist.entries]):
                 print("[Config:SaveVideos] Skipping deletion, found song in queue")
 
@@ -197,10 +223,118 @@ class MusicPlayer(EventEmitter):
 
         return False
 
+    def _discard_primed(self):
+        if self._primed:
+            entry, player = self._primed
+            self._primed = None
+            self._discard_unstarted(player)
+
+    @staticmethod
+    def _discard_unstarted(player):
+        """
+            Gets rid of a player whose thread never ran, so nothing else is going to clean up after it.
+        """
+        player.after = None
+
+        if player.process:
+            try:
+                player.process.kill()
+                player.process.wait()
+            except OSError:
+                pass
+        else:
+            player.buff.close()
+
+    def _take_primed(self, entry):
+        """
+            Returns the primed player if it's the one for `entry` and still good to use, otherwise gets rid of it.
+        """
+        if not self._primed:
+            return None
+
+        primed_entry, player = self._primed
+        self._primed = None
+
+        # A pre-encoded song can only be played at the volume it was made for.
+        if primed_entry is entry and (not isinstance(player, OpusPlayer) or self.bot.opus_cache.matches(self.volume)):
+            return player
+
+        self._discard_unstarted(player)
+        return None
+
+    def _start_primed(self):
+        """
+            Starts the primed player for the next song right away, when the last one has just finished.  This skips
+            the trip through `play`, so the frames of the next song follow the last ones without a gap.
+            Returns False if there's nothing primed, and `play` has to take care of it.
+        """
+        if not self._primed or self._play_lock.locked() or self._resume:
+            return False
+
+        entry = self.playlist.peek()
+        player = self._take_primed(entry)
+        if not player:
+            return False
+
+        self.playlist.pop_next()
+        self._streaming = False
+        self._track_gain = self.bot.track_gain(entry.filename)
+        self._begin(entry, player, entry.filename, "-nostdin")
+        return True
+
+    async def _prime_next(self):
+        """
+            Spawns the player for the next song shortly before the current one ends, so the next song can
+            start right away instead of waiting for ffmpeg to start up.
+        """
+        if self._play_lock.locked():
+            # The next song is being started right now, possibly with our primed player.
+            return
+
+        if self._primed and self._primed[0] is not self.playlist.peek():
+            self._discard_primed()
+
+        if self._primed or not self.is_playing or not self.current_entry or not self.current_entry.duration:
+            return
+
+        if self.current_entry.duration - self.position > GAPLESS_PRIME_SECONDS:
+            return
+
+        entry = self.playlist.peek()
+        if not entry or not entry.is_downloaded:
+            return
+
+        # The same choice _start_entry makes: the pre-encoded song if there is one, ffmpeg otherwise.
+        player = await self._create_opus_player(entry.filename, self.bot.track_gain(entry.filename))
+
+        if not player:
+            player = self._create_player(entry.filename, "-nostdin")
+            await self.loop.run_in_executor(None, player.buff.prime, self.voice_client.encoder.frame_size)
+
+        # Things might have moved on while ffmpeg was starting.
+        if self._primed or self.playlist.peek() is not entry or not self.is_playing:
+            self._discard_unstarted(player)
+            return
+
+        self._primed = (entry, player)
+
+    async def gapless_check(self):
+        while not self.is_dead:
+            try:
+                await self._prime_next()
+            except:
+                traceback.print_exc()
+            finally:
+                await asyncio.sleep(0.5)
+
     async def _delete_file(self, filename):
         for x in range(30):
             try:
-                os.unlink(filename)
+                await self.playlist.downloader.fs.unlink(filename)
+                self.playlist.downloader.cache_index.remove(filename)
+
+                if self.bot.opus_cache:
+                    await self.bot.opus_cache.discard(filename, self.bot.track_gain(filename))
                 break
 
             except PermissionError as e:
@@ -231,7 +365,7 @@ class MusicPlayer(EventEmitter):
         with await self._play_lock:
             if self.is_stopped or _continue:
                 try:
-                    entry = await self.playlist.get_next_entry()
+                    entry = await self.playlist.get_next_entry(stream=self.bot.config.stream_mode)
 
                 except Exception as e:
                     print("Failed to get entry.")
@@ -245,37 +379,203 @@ class MusicPlayer(EventEmitter):
                     self.stop()
                     return
 
-                # In-case there was a player, kill it. RIP.
-                self._kill_current_player()
+                start = 0
+                if self._resume and self._resume[0] is entry:
+                    start = self._resume[1]
+                self._resume = None
 
-                self._current_player = self._monkeypatch_player(self.voice_client.create_ffmpeg_player(
-                    entry.filename,
-                    before_options="-nostdin",
-                    options="-vn -b:a 128k",
-                    # Threadsafe call soon, b/c after will be called from the voice playback thread.
-                    after=lambda: self.loop.call_soon_threadsafe(self._playback_finished)
-                ))
-                self._current_player.setDaemon(True)
-                self._current_player.buff.volume = self.volume
+                try:
+                    await self._start_entry(entry, start=start)
 
-                # I need to add ytdl hooks
-                self.state = MusicPlayerState.PLAYING
-                self._current_entry = entry
+                except Exception as e:
+                    print("Failed to start entry.")
+                    traceback.print_exc()
+                    self.loop.call_later(0.1, self.play)
+
+    async def _play_downloaded(self, entry):
+        with await self._play_lock:
+            try:
+                await self._start_entry(entry, stream=False)
+
+            except Exception as e:
+                print("Failed to download entry after streaming it failed.")
+                traceback.print_exc()
+                self._current_entry = None
+                self.play(_continue=True)
+
+    async def _start_entry(self, entry, *, stream=True, start=0):
+        """
+            Starts the ffmpeg player for `entry`, `start` seconds into the song.  An entry that isn't downloaded
+            yet is streamed if possible, or downloaded first otherwise.
+        """
+        source = entry.filename
+        before_options = "-nostdin"
+        self._streaming = False
+        player = None
+
+        if start:
+            self._discard_primed()
+        else:
+            player = self._take_primed(entry)
+
+        if player is None and not entry.is_downloaded:
+            if stream:
+                try:
+                    source, headers = await entry.get_stream_info()
+                    before_options = self._stream_options(headers)
+                    self._streaming = True
+
+                except Exception as e:
+                    print("[Stream] Could not stream %s (%s), downloading it instead" % (entry.url, e))
+
+            if not self._streaming:
+                await entry.get_ready_future(DownloadPriority.PLAYING)
+                source = entry.filename
+
+        self._track_gain = self.bot.track_gain(None if self._streaming else source)
 
-                self._current_player.start()
-                self.emit('play', player=self, entry=entry)
+        if player is None and not self._streaming and not start:
+            player = await self._create_opus_player(source, self._track_gain)
+
+        self._begin(entry, player, source, before_options, start)
+
+    def _begin(self, entry, player, source, before_options, start=0):
+        # In-case there was a player, kill it. RIP.
+        self._kill_current_player()
+
+        self._source = (source, before_options)
+        self._current_player = player or self._create_player(source, self._seek_options(before_options, start))
+        self._current_player.buff.volume = self.volume * self._track_gain
+        self._position_offset = start
+
+        # I need to add ytdl hooks
+        self.state = MusicPlayerState.PLAYING
+        self._current_entry = entry
+
+        self._current_player.start()
+        self.emit('play', player=self, entry=entry)
+
+    def _create_player(self, source, before_options):
+        # Threadsafe call soon, b/c after will be called from the voice playback thread.
+        after = lambda: self.loop.call_soon_threadsafe(self._playback_finished)
+
+        # A plain local file can go to one of the ffmpeg processes that are already waiting.
+        process = self.bot.decoder_pool.take(source) if before_options == "-nostdin" else None
+
+        if process:
+            player = ProcessPlayer(process, self.voice_client, after)
+        else:
+            player = self.voice_client.create_ffmpeg_player(
+                source,
+                before_options=before_options,
+                options="-vn -b:a 128k",
+                after=after
+            )
+
+        player = self._monkeypatch_player(player)
+        player.setDaemon(True)
+        return player
+
+    async def _create_opus_player(self, filename, track_gain):
+        """
+            Returns a player sending the pre-encoded version of `filename`, if there is one for the current volume.
+        """
+        opus_cache = self.bot.opus_cache
+
+        if not opus_cache or not opus_cache.matches(self.volume):
+            return None
+
+        opus_file = await opus_cache.find(filename, track_gain)
+        if not opus_file:
+            return None
+
+        player = OpusPlayer(opus_file, opus_cache.gain * track_gain, self.voice_client,
+                            after=lambda: self.loop.call_soon_threadsafe(self._playback_finished))
+        player.setDaemon(True)
+        return player
+
+    @staticmethod
+    def _seek_options(before_options, position):
+        # -ss before the input makes ffmpeg skip ahead in the file itself, rather than decoding everything up to it.
+        return "%s -ss %.2f" % (before_options, position) if position else before_options
+
+    @staticmethod
+    def _retire_player(player):
+        """
+            Stops a player thread without it calling back, whether it's paused or blocked on ffmpeg.
+        """
+        player.after = None
+        player.stop()
+
+        if player.process:
+            try:
+                player.process.kill()
+            except OSError:
+                pass
+
+        # A paused thread is waiting to be resumed, with ffmpeg gone it reads nothing and ends right after.
+        player._resumed.set()
+
+    def _restart_at(self, position):
+        """
+            Carries on with the current entry `position` seconds in, with a new ffmpeg player.  This is how we seek,
+            move from a pre-encoded version to ffmpeg (which can do any volume) and get going on a new voice client.
+        """
+        source, before_options = self._source
+
+        self._retire_player(self._current_player)
+
+        player = self._create_player(source, self._seek_options(before_options, position))
+        player.buff.volume = self.volume * self._track_gain
+
+        if self.is_paused:
+            player.pause()
+
+        self._current_player = player
+        self._position_offset = position
+        player.start()
+
+    def seek(self, position):
+        """
+            Jumps to `position` seconds into the current entry.  Returns where we ended up, or None if nothing is playing.
+        """
+        if not self._current_player or not self._current_entry or self._play_lock.locked():
+            return None
+
+        position = max(0, position)
+        if self._current_entry.duration:
+            position = min(position, max(0, self._current_entry.duration - 1))
+
+        self._restart_at(position)
+        return position
+
+    def resume_at(self, entry, position):
+        """
+            Makes `entry` start `position` seconds in when it's played, like after a restart.
+        """
+        self._resume = (entry, position)
+
+    @staticmethod
+    def _stream_options(headers):
+        # Let ffmpeg ride out hiccups in the connection instead of ending the song early.
+        options = "-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+        if headers:
+            options += " -headers " + shlex.quote(''.join('%s: %s\r\n' % item for item in headers.items()))
+
+        return options
 
     def _monkeypatch_player(self, player):
         original_buff = player.buff
-        player.buff = PatchedBuff(original_buff)
+        player.buff = PatchedBuff(original_buff, meter=self.meter)
         return player
 
     def reload_voice(self, voice_client):
         self.voice_client = voice_client
-        if self._current_player:
-            self._current_player.player = voice_client.play_audio
-            self._current_player._resumed.clear()
-            self._current_player._connected.set()
+        self._discard_primed()
+        if self._current_player and self._current_entry:
+            # The old player is tied to the old connection, pick up where it was on the new one.
+            self._restart_at(self.position)
 
     async def websocket_check(self):
         if self.bot.config.debug_mode:
@@ -313,13 +613,25 @@ class MusicPlayer(EventEmitter):
     def is_dead(self):
         return self.state == MusicPlayerState.DEAD
 
+    @property
+    def is_pre_encoded(self):
+        # Opus packets go straight to discord, there's no pcm for the meter to measure.
+        return isinstance(self._current_player, OpusPlayer)
+
+    @property
+    def position(self):
+        """
+            How far into the current entry we are in seconds, going by the amount of audio actually sent.
+            This stands still while paused and carries on where it was when the voice connection is reloaded.
+        """
+        if not self._current_player:
+            return 0.0
+
+        return self._position_offset + self._current_player.buff.bytes_read / PCM_BYTES_PER_SECOND
+
     @property
     def progress(self):
-        return round(self._current_player.buff.frame_count * 0.02)
-        # TODO: Properly implement this
-        #       Correct calculation should be bytes_read/192k
-        #       192k AKA sampleRate * (bitDepth / 8) * channelCount
-        #       Change frame_count to bytes_read in the PatchedBuff
+        return round(self.position)
 
 
 # if redistributing ffmpeg is an issue, it can be downloaded from here:
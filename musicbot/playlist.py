@@ -1,13 +1,26 @@
+import asyncio
 import datetime
+import threading
 import traceback
-from collections import deque
-from itertools import islice
+from collections import defaultdict, deque, OrderedDict
 from random import shuffle
 
 from .utils import get_header
-from .entry import URLPlaylistEntry
+from .entry import URLPlaylistEntry, LazyPlaylistEntry
+from .scheduler import DownloadPriority
 from .exceptions import ExtractionError, WrongEntryTypeError
 from .lib.event_emitter import EventEmitter
+from .lib.indexed_sequence import IndexedSequence
+
+# Rough size of a cached song per second of audio, used to keep the prefetch window within its disk budget.
+ESTIMATED_BYTES_PER_SECOND = 16000
+
+# Songs of a playlist that are looked up at the same time, and how long one lookup may take before it's skipped.
+PLAYLIST_CONCURRENCY = 4
+PLAYLIST_ITEM_TIMEOUT = 30
+
+# What the songs in a flat playlist listing (process=False) look like, they still need to be looked up.
+FLAT_ENTRY_TYPES = ('url', 'url_transparent')
 
 
 class Playlist(EventEmitter):
@@ -20,29 +33,128 @@ class Playlist(EventEmitter):
         self.bot = bot
         self.loop = bot.loop
         self.downloader = bot.downloader
-        self.entries = deque()
+        self.entries = IndexedSequence(weight=lambda entry: entry.duration or 0)  # weighed by duration for estimates
+        self._by_author = defaultdict(OrderedDict)  # author id -> their entries, in queue order
+        self._prefetching = set()
 
     def __iter__(self):
         return iter(self.entries)
 
     def shuffle(self):
-        shuffle(self.entries)
+        entries = list(self.entries)
+        shuffle(entries)
+
+        self.entries.clear()
+        self.entries.extend(entries)
+
+        self._by_author.clear()
+        for entry in entries:
+            self._index(entry)
+
+        self._update_prefetch()
 
     def clear(self):
         self.entries.clear()
+        self._by_author.clear()
+        self._update_prefetch()
+
+    def remove_entry(self, entry):
+        """
+            Removes `entry` from the queue.  Raises ValueError if it isn't in there.
+        """
+        self.entries.remove(entry)
+        self._unindex(entry)
+        self._update_prefetch()
+
+    def remove_entries(self, entries):
+        """
+            Removes those of `entries` that are in the queue, all at once.  Returns the entries that were removed.
+        """
+        removed = []
+
+        for entry in entries:
+            if entry in self.entries:
+                self.entries.remove(entry)
+                self._unindex(entry)
+                removed.append(entry)
+
+        if removed:
+            self._update_prefetch()
+
+        return removed
+
+    def entry_at(self, position):
+        """
+            Returns the entry at `position`, counting from 1.  Raises IndexError if there's no such entry.
+        """
+        if position < 1:
+            raise IndexError('position out of range')
+
+        return self.entries[position - 1]
+
+    def remove_at(self, position):
+        """
+            Removes and returns the entry at `position`, counting from 1.  Raises IndexError if there's no such entry.
+        """
+        entry = self.entry_at(position)
+        self.remove_entry(entry)
+        return entry
+
+    def move(self, position, new_position):
+        """
+            Moves the entry at `position` to `new_position`, both counting from 1.  Returns the entry.
+            Raises IndexError if there's no entry at `position`, a `new_position` past the end moves it to the end.
+        """
+        entry = self.entry_at(position)
+        del self.entries[position - 1]
+        self.entries.insert(max(0, new_position - 1), entry)
+
+        # Moves are rare, so this is where the author's entries are put back in queue order.  That keeps
+        # listing them (which happens all the time) a plain walk through them.
+        entries = self._by_author.get(entry.author_id)
+        if entries:
+            self._by_author[entry.author_id] = OrderedDict.fromkeys(sorted(entries, key=self.entries.index))
+
+        self._update_prefetch()
+        return entry
+
+    def _index(self, entry, *, head=False):
+        if entry.author_id:
+            entries = self._by_author[entry.author_id]
+            entries[entry] = None
+
+            if head:
+                entries.move_to_end(entry, last=False)
+
+    def _unindex(self, entry):
+        entries = self._by_author.get(entry.author_id)
+        if entries is not None:
+            entries.pop(entry, None)
+
+            if not entries:
+                del self._by_author[entry.author_id]
 
-    async def add_entry(self, song_url, **meta):
+    async def add_entry(self, song_url, *, head=False, **meta):
         """
             Validates and adds a song_url to be played. This does not start the download of the song.
 
             Returns the entry & the position it is in the queue.
 
             :param song_url: The song url to add to the playlist.
+            :param head: Add the song to the front of the queue, so it plays next.
             :param meta: Any additional metadata to add to the playlist entry.
         """
+        entry = await self._make_entry(song_url, **meta)
+        self._add_entry(entry, head=head)
+        return entry, 1 if head else len(self.entries)
 
+    async def _make_entry(self, song_url, *, cancel=None, **meta):
+        """
+            Looks up `song_url` and returns an entry for it, without adding it to the playlist.
+            Setting the threading.Event `cancel` calls off the lookup.
+        """
         try:
-            info = await self.downloader.extract_info(self.loop, song_url, download=False)
+            info = await self.downloader.extract_info(self.loop, song_url, download=False, cancel=cancel)
         except Exception as e:
             raise ExtractionError('Could not extract information from {}\n\n{}'.format(song_url, e))
 
@@ -81,23 +193,44 @@ class Playlist(EventEmitter):
             self.downloader.ytdl.prepare_filename(info),
             **meta
         )
-        self._add_entry(entry)
-        return entry, len(self.entries)
+        return entry
 
-    async def import_from(self, playlist_url, **meta):
+    async def import_from(self, playlist_url, *, max_duration=0, **meta):
         """
-            Imports the songs from `playlist_url` and queues them to be played.
+            Imports the songs from `playlist_url` and queues them to be played.  When the playlist can be listed
+            without looking up every song, they're queued right away and looked up when they're close to playing.
 
             Returns a list of `entries` that have been enqueued.
 
             :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+            :param max_duration: Songs that turn out to be longer than this are dropped when they're looked up
             :param meta: Any additional metadata to add to the playlist entry
         """
         position = len(self.entries) + 1
+
+        try:
+            listing = await self.downloader.safe_extract_info(self.loop, playlist_url, download=False, process=False)
+        except Exception as e:
+            raise ExtractionError('Could not extract information from {}\n\n{}'.format(playlist_url, e))
+
+        items = await self._list_entries(listing)
+        entry_list = self._lazy_entries(items, self._listing_url, max_duration=max_duration, **meta)
+
+        if entry_list is not None:
+            self._add_entries(entry_list)
+            return entry_list, position
+
         entry_list = []
 
+        if not items:
+            raise ExtractionError('Could not extract information from %s' % playlist_url)
+
+        # The listing doesn't have enough to go on, so every song is looked up.  The listing itself is reused
+        # for that, instead of extracting the whole playlist again.
+        listing['entries'] = [item for item in items if item]
+
         try:
-            info = await self.downloader.safe_extract_info(self.loop, playlist_url, download=False)
+            info = await self.downloader.safe_process_info(self.loop, listing)
         except Exception as e:
             raise ExtractionError('Could not extract information from {}\n\n{}'.format(playlist_url, e))
 
@@ -139,11 +272,12 @@ class Playlist(EventEmitter):
 
         return entry_list, position
 
-    async def async_process_youtube_playlist(self, playlist_url, **meta):
+    async def async_process_youtube_playlist(self, playlist_url, *, max_duration=0, **meta):
         """
             Processes youtube playlists links from `playlist_url` in a questionable, async fashion.
 
             :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+            :param max_duration: Songs that turn out to be longer than this are dropped when they're looked up
             :param meta: Any additional metadata to add to the playlist entry
         """
 
@@ -155,35 +289,16 @@ class Playlist(EventEmitter):
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
-        gooditems = []
-        baditems = 0
-        for entry_data in info['entries']:
-            if entry_data:
-                baseurl = info['webpage_url'].split('playlist?list=')[0]
-                song_url = baseurl + 'watch?v=%s' % entry_data['id']
-
-                try:
-                    entry, elen = await self.add_entry(song_url, **meta)
-                    gooditems.append(entry)
-                except ExtractionError:
-                    baditems += 1
-                except Exception as e:
-                    baditems += 1
-                    print("There was an error adding the song {}: {}: {}\n".format(
-                        entry_data['id'], e.__class__.__name__, e))
-            else:
-                baditems += 1
-
-        if baditems:
-            print("Skipped %s bad entries" % baditems)
-
-        return gooditems
+        baseurl = info['webpage_url'].split('playlist?list=')[0]
+        return await self._add_listing(
+            info, lambda entry_data: baseurl + 'watch?v=%s' % entry_data['id'], max_duration=max_duration, **meta)
 
-    async def async_process_sc_bc_playlist(self, playlist_url, **meta):
+    async def async_process_sc_bc_playlist(self, playlist_url, *, max_duration=0, **meta):
         """
             Processes soundcloud set and bancdamp album links from `playlist_url` in a questionable, async fashion.
 
             :param playlist_url: The playlist url to be cut into individual urls and added to the playlist
+            :param max_duration: Songs that turn out to be longer than this are dropped when they're looked up
             :param meta: Any additional metadata to add to the playlist entry
         """
 
@@ -195,54 +310,229 @@ class Playlist(EventEmitter):
         if not info:
             raise ExtractionError('Could not extract information from %s' % playlist_url)
 
+        return await self._add_listing(info, lambda entry_data: entry_data['url'], max_duration=max_duration, **meta)
+
+    async def _list_entries(self, listing):
+        """
+            The songs in a flat playlist listing.  Going through them can mean fetching more pages of the playlist,
+            so that's done in a thread.
+        """
+        if not listing or not listing.get('entries'):
+            return []
+
+        return await self.loop.run_in_executor(self.downloader.thread_pool, list, listing['entries'])
+
+    @staticmethod
+    def _listing_url(item):
+        url = item.get('webpage_url') or item['url']
+
+        # Youtube's listings only have the video id.
+        if item.get('ie_key') == 'Youtube' and '/' not in url:
+            url = 'https://www.youtube.com/watch?v=%s' % url
+
+        return url
+
+    def _lazy_entries(self, items, url_for, *, max_duration=0, **meta):
+        """
+            Makes a LazyPlaylistEntry for every song in a flat playlist listing, or returns None if the listing
+            doesn't have enough to go on (a title for every song).
+        """
+        items = [item for item in items if item]
+
+        if not items or not all(item.get('_type') in FLAT_ENTRY_TYPES and item.get('title') for item in items):
+            return None
+
+        return [
+            LazyPlaylistEntry(self, url_for(item), item['title'], item.get('duration', 0) or 0,
+                              max_duration=max_duration, **meta)
+            for item in items
+        ]
+
+    async def _add_listing(self, listing, url_for, *, max_duration=0, **meta):
+        """
+            Adds the songs from a flat playlist listing, right away if possible or else looked up a few at a time.
+        """
+        items = await self._list_entries(listing)
+        entries = self._lazy_entries(items, url_for, max_duration=max_duration, **meta)
+
+        if entries is not None:
+            self._add_entries(entries)
+            return entries
+
+        return await self._add_entries_concurrently((url_for(item) if item else None for item in items), **meta)
+
+    async def _add_entries_concurrently(self, song_urls, **meta):
+        """
+            Looks up `song_urls` PLAYLIST_CONCURRENCY at a time, and adds them in the same order as soon as the
+            songs before them are in.  A song that takes longer than PLAYLIST_ITEM_TIMEOUT to look up is skipped.
+            Returns the entries that were added.
+        """
         gooditems = []
         baditems = 0
-        for entry_data in info['entries']:
-            if entry_data:
-                song_url = entry_data['url']
+        pending = deque()  # (song url, lookup) in playlist order
 
-                try:
-                    entry, elen = await self.add_entry(song_url, **meta)
-                    gooditems.append(entry)
-                except ExtractionError:
-                    baditems += 1
-                except Exception as e:
-                    baditems += 1
-                    print("There was an error adding the song {}: {}: {}\n".format(
-                        entry_data['id'], e.__class__.__name__, e))
-            else:
+        async def add_next():
+            nonlocal baditems
+            song_url, lookup = pending.popleft()
+
+            try:
+                entry = await lookup
+
+            except ExtractionError:
+                baditems += 1
+
+            except asyncio.TimeoutError:
+                baditems += 1
+                print("Looking up %s took too long, skipping it" % song_url)
+
+            except Exception as e:
                 baditems += 1
+                print("There was an error adding the song {}: {}: {}\n".format(song_url, e.__class__.__name__, e))
+
+            else:
+                self._add_entry(entry)
+                gooditems.append(entry)
+
+        try:
+            for song_url in song_urls:
+                if not song_url:
+                    baditems += 1
+                    continue
+
+                if len(pending) >= PLAYLIST_CONCURRENCY:
+                    await add_next()
+
+                # Timing out only stops waiting for the lookup, the event stops the lookup itself in its thread.
+                cancel = threading.Event()
+                lookup = asyncio.ensure_future(asyncio.wait_for(
+                    self._make_entry(song_url, cancel=cancel, **meta), PLAYLIST_ITEM_TIMEOUT), loop=self.loop)
+                lookup.add_done_callback(lambda lookup, cancel=cancel: cancel.set())
+                pending.append((song_url, lookup))
+
+            while pending:
+                await add_next()
+
+        finally:
+            # Only left over when we were cancelled.
+            for song_url, lookup in pending:
+                lookup.cancel()
 
         if baditems:
             print("Skipped %s bad entries" % baditems)
 
         return gooditems
 
-    def _add_entry(self, entry):
-        self.entries.append(entry)
+    def _add_entry(self, entry, *, head=False):
+        if head:
+            self.entries.appendleft(entry)
+        else:
+            self.entries.append(entry)
+        self._index(entry, head=head)
         self.emit('entry-added', playlist=self, entry=entry)
+        self._update_prefetch()
+
+    def _add_entries(self, entries):
+        """
+            Adds a batch of entries at the end of the queue.  They're announced as one and the prefetch window
+            is only worked out once, instead of for every entry.
+        """
+        self.entries.extend(entries)
+        for entry in entries:
+            self._index(entry)
+
+        if entries:
+            self.emit('entry-added', playlist=self, entry=entries[0])
+        self._update_prefetch()
+
+    def restore(self, entries):
+        """
+            Puts back entries from a snapshot.  Unlike adding them one by one, nothing is announced and the
+            prefetch window is only worked out once.
+        """
+        self.entries.extend(entries)
+        for entry in entries:
+            self._index(entry)
+        self._update_prefetch()
+
+    def _update_prefetch(self, enabled=True):
+        """
+            Keeps the songs at the front of the queue downloaded ahead of time.  The window is limited by the
+            number of songs, their total length and a rough estimate of their size on disk, and always holds
+            at least the next song.  Songs that fell out of the window lose their queued downloads.
+        """
+        config = self.bot.config
+        window = set()
+        seconds = 0
+        size = 0
+
+        for position, entry in enumerate(self.entries if enabled else ()):
+            if position >= max(1, config.prefetch_count):
+                break
+
+            if position:
+                if config.prefetch_seconds and seconds >= config.prefetch_seconds:
+                    break
+
+                estimated_size = entry.duration * ESTIMATED_BYTES_PER_SECOND
+                if config.prefetch_disk_budget and size + estimated_size > config.prefetch_disk_budget * 1024 * 1024:
+                    break
+
+            seconds += entry.duration
+            size += entry.duration * ESTIMATED_BYTES_PER_SECOND
+            window.add(entry)
+
+            if not position:
+                entry.prefetch(DownloadPriority.NEXT_UP)
+            elif entry.author_id is None:
+                entry.prefetch(DownloadPriority.AUTOPLAYLIST)
+            else:
+                entry.prefetch(DownloadPriority.PREFETCH)
+
+        for entry in self._prefetching - window:
+            entry.cancel_prefetch()
 
-        if self.peek() is entry:
-            entry.get_ready_future()
+        self._prefetching = window
 
-    async def get_next_entry(self, predownload_next=True):
+    async def get_next_entry(self, predownload_next=True, *, stream=False):
         """
             A coroutine which will return the next song or None if no songs left to play.
 
-            Additionally, if predownload_next is set to True, it will attempt to download the next
-            song to be played - so that it's ready by the time we get to it.
+            Additionally, if predownload_next is set to True, it will attempt to download the songs in the
+            prefetch window - so that they're ready by the time we get to them.
+
+            If stream is set to True, a song that isn't downloaded yet is returned right away so the player
+            can stream it.  It is still downloaded in the background if SaveVideos or a CacheBudget is set.
         """
         if not self.entries:
             return None
 
-        entry = self.entries.popleft()
+        entry = self._popleft()
+
+        if stream and not entry.is_downloaded:
+            if self.bot.config.save_videos or self.bot.config.cache_budget:
+                entry.prefetch(DownloadPriority.PREFETCH)
+
+            self._update_prefetch(predownload_next)
+            return entry
 
-        if predownload_next:
-            next_entry = self.peek()
-            if next_entry:
-                next_entry.get_ready_future()
+        ready_future = entry.get_ready_future(DownloadPriority.PLAYING)
+        self._update_prefetch(predownload_next)
 
-        return await entry.get_ready_future()
+        return await ready_future
+
+    def pop_next(self, predownload_next=True):
+        """
+            Takes the next entry off the queue without waiting for it, for when the player already has it ready.
+        """
+        entry = self._popleft()
+        self._update_prefetch(predownload_next)
+        return entry
+
+    def _popleft(self):
+        entry = self.entries.popleft()
+        self._unindex(entry)
+        self._prefetching.discard(entry)
+        return entry
 
     def peek(self):
         """
@@ -255,7 +545,7 @@ class Playlist(EventEmitter):
         """
             (very) Roughly estimates the time till the queue will 'position'
         """
-        estimated_time = sum([e.duration for e in islice(self.entries, position - 1)])
+        estimated_time = self.entries.weight_before(position - 1)
 
         # When the player plays a song, it eats the first playlist item, so we just have to add the time back
         if not player.is_stopped and player.current_entry:
@@ -263,7 +553,19 @@ class Playlist(EventEmitter):
 
         return datetime.timedelta(seconds=estimated_time)
 
+    def position_of(self, entry):
+        """
+            Where `entry` is in the queue, counting from 1 like the queue command does.  Raises ValueError if it isn't in there.
+        """
+        return self.entries.index(entry) + 1
+
     def count_for_user(self, user):
-        return sum(1 for e in self.entries if e.meta.get('author', None) == user)
+        return len(self._by_author.get(user.id, ()))
+
+    def entries_for_user(self, user):
+        """
+            The entries `user` has in the queue, in the order they'll be played.
+        """
+        return list(self._by_author.get(user.id, ()))
 
 
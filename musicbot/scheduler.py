@@ -0,0 +1,172 @@
+import heapq
+import asyncio
+import threading
+import traceback
+
+from enum import IntEnum
+from itertools import count
+from collections import OrderedDict
+
+from .exceptions import DownloadPreempted
+
+
+class DownloadPriority(IntEnum):
+    PLAYING = 0       # The player is waiting on this one right now
+    NEXT_UP = 1       # The next entry in the queue
+    PREFETCH = 2      # Further down the queue, downloaded ahead of time
+    AUTOPLAYLIST = 3  # Autoplaylist songs being warmed up
+
+    def __str__(self):
+        return self.name
+
+
+class _DownloadJob:
+    def __init__(self, key, priority, seq):
+        self.key = key
+        self.funcs = OrderedDict()  # owner -> func, run one after the other
+        self.priority = priority
+        self.seq = seq
+        self.cancel = threading.Event()
+        self.running = False
+
+
+class DownloadScheduler:
+    """
+        Sits in front of the Downloader and decides which downloads get to run.
+
+        Jobs are started in order of priority (and then submission) with at most `max_concurrent` running
+        at the same time.  When every slot is taken and something more important comes in, the least
+        important running job is asked to stop.  It gets put back in the queue and resumes later.
+
+        Everyone who wants the same thing (the same `key`) shares a job.  Their functions are run one after
+        the other in that job, so only the first really downloads and the others find the song in the cache.
+    """
+
+    def __init__(self, loop=None, *, max_concurrent=2):
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_concurrent = max_concurrent
+
+        self._queue = []  # heap of (priority, seq, job), may hold stale items of reprioritized jobs
+        self._jobs = {}
+        self._running = set()
+        self._seq = count()
+
+        self.completed = 0
+        self.preempted = 0
+
+    def submit(self, key, func, priority=DownloadPriority.NEXT_UP, *, owner=None):
+        """
+            Schedules `func(cancel)` to be run on behalf of `owner` (`key` by default).  If a job for `key` already
+            exists, `func` joins it (unless `owner` is already in it) and the job is bumped to `priority` if that's
+            more important.  `cancel` is a threading.Event that is set when the job should give up its slot.
+            It should raise DownloadPreempted when it does.
+        """
+        job = self._jobs.get(key)
+
+        if job is None:
+            job = self._jobs[key] = _DownloadJob(key, priority, next(self._seq))
+            heapq.heappush(self._queue, (job.priority, job.seq, job))
+
+        job.funcs.setdefault(key if owner is None else owner, func)
+
+        if priority < job.priority:
+            job.priority = priority
+
+            if not job.running:
+                heapq.heappush(self._queue, (job.priority, job.seq, job))
+
+        self._pump()
+
+    def cancel(self, key, *, owner=None):
+        """
+            Takes `owner` out of the job for `key` if it hasn't started yet, the job is dropped once nobody is
+            left in it.  Returns True if `owner` was waiting on such a job.
+        """
+        job = self._jobs.get(key)
+        owner = key if owner is None else owner
+
+        if job is None or job.running or owner not in job.funcs:
+            return False
+
+        del job.funcs[owner]
+
+        if not job.funcs:
+            del self._jobs[key]
+        return True
+
+    def _pump(self):
+        while self._queue:
+            priority, seq, job = self._queue[0]
+
+            if job.running or self._jobs.get(job.key) is not job or job.priority != priority:
+                heapq.heappop(self._queue)
+                continue
+
+            if len(self._running) < self.max_concurrent:
+                heapq.heappop(self._queue)
+                self._start(job)
+                continue
+
+            # Every slot is busy, see if there's something less important we can kick out.
+            # Only one at a time though, the job we already asked to stop will free up a slot soon enough.
+            if self._running and not any(j.cancel.is_set() for j in self._running):
+                victim = max(self._running, key=lambda j: (j.priority, j.seq))
+
+                if victim.priority > priority:
+                    victim.cancel.set()
+
+            break
+
+    def _start(self, job):
+        job.running = True
+        self._running.add(job)
+        asyncio.ensure_future(self._run(job), loop=self.loop)
+
+    async def _run(self, job):
+        preempted = False
+
+        # Owners can join while this runs, they're picked up too.
+        while job.funcs:
+            owner, func = next(iter(job.funcs.items()))
+
+            try:
+                await func(job.cancel)
+
+            except DownloadPreempted:
+                preempted = True
+                break
+
+            except Exception:
+                traceback.print_exc()
+
+            job.funcs.pop(owner, None)
+
+        job.running = False
+        self._running.discard(job)
+
+        if preempted:
+            self.preempted += 1
+            job.cancel = threading.Event()
+            heapq.heappush(self._queue, (job.priority, job.seq, job))
+
+        else:
+            del self._jobs[job.key]
+            self.completed += 1
+
+        self._pump()
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    def queue_depth(self):
+        """
+            Returns the number of queued (not running) jobs for each priority.
+        """
+        depth = dict.fromkeys(DownloadPriority, 0)
+
+        for job in self._jobs.values():
+            if not job.running:
+                depth[job.priority] += 1
+
+        return depth
@@ -0,0 +1,137 @@
+import json
+import asyncio
+import traceback
+
+from .entry import URLPlaylistEntry, LazyPlaylistEntry
+from .utils import load_json, write_file_atomic
+
+# Entries are saved as rows of these, so a long queue doesn't repeat every key for every song.
+ENTRY_FIELDS = ('url', 'title', 'duration', 'expected_filename', 'channel', 'author', 'max_duration')
+
+
+class QueueSnapshots:
+    """
+        Saves the queue of every server, with the song that's playing and how far into it, when the bot shuts
+        down and, unless `interval` is 0, every `interval` seconds while `run` is going.  After a restart `restore`
+        puts it all back, for all servers at once.
+
+        Entries are saved with everything needed to rebuild them, so restoring doesn't look up a single link again.
+    """
+
+    def __init__(self, bot, path, *, interval=30):
+        self.bot = bot
+        self.path = path
+        self.interval = interval
+
+        self.saved = 0
+        self.restored = 0
+        self._ready = False  # don't overwrite the last snapshot before it's been restored
+        self._closed = False  # the shutdown snapshot was taken, the players are on their way out
+        self._last = None
+
+    def take(self):
+        servers = {}
+
+        for server_id, player in self.bot.players.items():
+            voice_client = self.bot.the_voice_clients.get(server_id)
+            current = player.current_entry
+
+            if not voice_client or (not current and not player.playlist.entries):
+                continue
+
+            servers[server_id] = {
+                'voice_channel': voice_client.channel.id,
+                'current': self._pack(current) if current else None,
+                'position': round(player.position, 2) if current else 0,
+                'entries': [self._pack(entry) for entry in player.playlist]
+            }
+
+        return {'fields': ENTRY_FIELDS, 'servers': servers}
+
+    @staticmethod
+    def _pack(entry):
+        data = entry.to_dict()
+        return [data.get(field) for field in ENTRY_FIELDS]
+
+    @staticmethod
+    def _unpack(playlist, fields, row):
+        data = dict(zip(fields, row))
+
+        # Songs from a playlist that weren't looked up yet don't have a file name, they stay lazy.
+        entry_type = URLPlaylistEntry if data['expected_filename'] else LazyPlaylistEntry
+        return entry_type.from_dict(playlist, data)
+
+    async def save(self, *, final=False):
+        """
+            Writes the queues to disk, if they changed.  With `final` this is the snapshot taken on the way down,
+            nothing after it gets saved (like the empty queues left once every player is disconnected).
+        """
+        if not self._ready or self._closed:
+            return
+
+        self._closed = final
+
+        text = json.dumps(self.take(), separators=(',', ':'))
+        if text == self._last:
+            return
+
+        await self.bot.downloader.fs.run(write_file_atomic, self.path, text)
+        self._last = text
+        self.saved += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.save()
+            except Exception:
+                traceback.print_exc()
+
+    async def restore(self):
+        """
+            Puts back the queues from the last snapshot.  Only does anything the first time it's called.
+        """
+        if self._ready:
+            return
+
+        snapshot = await self.bot.downloader.fs.run(load_json, self.path, 'queue snapshot')
+        fields = snapshot.get('fields', ENTRY_FIELDS)
+        servers = snapshot.get('servers', {})
+
+        # Joining the voice channels is what takes the time, so do every server at the same time.
+        results = await asyncio.gather(
+            *[self._restore_server(saved, fields) for saved in servers.values()], return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                print("[Snapshot] Could not restore a queue: %s" % result)
+            else:
+                self.restored += result
+
+        if servers:
+            print("[Snapshot] Restored %s songs on %s servers" % (self.restored, len(servers)))
+
+        self._ready = True
+
+    async def _restore_server(self, saved, fields):
+        channel = self.bot.get_channel(saved['voice_channel'])
+        if not channel:
+            return 0
+
+        player = await self.bot.get_player(channel, create=True)
+        playlist = player.playlist
+
+        entries = [self._unpack(playlist, fields, row) for row in saved['entries']]
+
+        if saved['current']:
+            current = self._unpack(playlist, fields, saved['current'])
+            player.resume_at(current, saved['position'])
+            entries.insert(0, current)
+
+        playlist.restore(entries)
+
+        if player.is_stopped:
+            player.play()
+
+        return len(entries)
@@ -1,5 +1,8 @@
+import os
 import re
+import json
 import aiohttp
+import hashlib
 import decimal
 import unicodedata
 
@@ -31,6 +34,35 @@ def write_file(filename, contents):
             f.write('\n')
 
 
+def load_json(path, what):
+    """
+        Loads a json file written by `write_file_atomic`.  A missing or broken file gives an empty dict.
+    """
+    try:
+        with open(path, encoding='utf8') as f:
+            return json.load(f)
+
+    except FileNotFoundError:
+        pass
+
+    except (OSError, ValueError) as e:
+        print("[Warning] Could not load the %s (%s), starting over" % (what, e))
+
+    return {}
+
+
+def write_file_atomic(path, text):
+    """
+        Writes `text` to a temporary file first, so a crash halfway through doesn't leave a broken file behind.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        f.write(text)
+
+    os.replace(path + '.tmp', path)
+
+
 def slugify(value):
     value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
     value = re.sub('[^\w\s-]', '', value).strip().lower()
@@ -83,3 +115,32 @@ def md5sum(filename, limit=0):
         for chunk in iter(lambda: f.read(8192), b""):
             fhash.update(chunk)
     return fhash.hexdigest()[-limit:]
+
+
+class HashingWriter:
+    """
+        Wraps a writable file and hashes everything written to it, so we know the hash of a download
+        the moment it's done instead of having to read the whole file again.
+    """
+
+    def __init__(self, file, algorithm='sha256'):
+        self.file = file
+        self.hash = hashlib.new(algorithm)
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
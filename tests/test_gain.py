@@ -0,0 +1,70 @@
+from array import array
+
+import pytest
+
+from musicbot import gain
+
+FRAME = array('h', [1000, -1000] * 960).tobytes()  # 20ms of 48KHz stereo
+
+
+@pytest.fixture(params=gain.BACKENDS, ids=lambda backend: backend.name)
+def backend(request):
+    return request.param
+
+
+def test_unity_gain_returns_frame(backend):
+    assert backend(1.0).process(FRAME) is FRAME
+
+
+def test_scale(backend):
+    samples = array('h', backend(0.5).process(FRAME))
+    assert samples[:2].tolist() == [500, -500]
+    assert len(samples) * 2 == len(FRAME)
+
+
+def test_gain_is_clamped(backend):
+    stage = backend(10.0)
+    assert stage.target == gain.MAX_GAIN
+
+    stage.set_gain(-1.0)
+    assert stage.target == 0.0
+
+
+def test_ramp_ends_at_target(backend):
+    stage = backend(0.0)
+    stage.set_gain(1.0)
+
+    samples = array('h', stage.process(FRAME))
+    assert len(samples) * 2 == len(FRAME)
+    assert abs(samples[0]) < abs(samples[-1])
+    assert abs(samples[-2]) >= 900
+
+    # After the ramp the gain stays put.
+    assert stage.process(FRAME) is FRAME
+
+
+def test_set_gain_without_ramp(backend):
+    stage = backend(1.0)
+    stage.set_gain(0.5, ramp=False)
+    assert array('h', stage.process(FRAME))[:2].tolist() == [500, -500]
+
+
+@pytest.mark.parametrize('gains', [(1.0, 0.5), (0.5, 1.0), (0.5, 0.5)])
+def test_empty_frame(backend, gains):
+    stage = backend(gains[0])
+    stage.set_gain(gains[1])
+    assert stage.process(b'') == b''
+
+
+@pytest.mark.parametrize('samples', [1, 2, 3, 7, 9, 15])
+def test_short_frame_ramp(backend, samples):
+    frame = array('h', [1000, -1000] * samples).tobytes()
+    stage = backend(0.0)
+    stage.set_gain(1.0)
+
+    assert len(stage.process(frame)) == len(frame)
+
+
+def test_rms():
+    assert gain.rms(b'') == 0
+    assert gain.rms(FRAME) == 1000
@@ -0,0 +1,144 @@
+import random
+
+import pytest
+
+from musicbot.lib.indexed_sequence import IndexedSequence
+
+
+class Item:
+    def __init__(self, weight):
+        self.weight = weight
+
+    def __repr__(self):
+        return 'Item(%s)' % self.weight
+
+
+def make(weights):
+    items = [Item(w) for w in weights]
+    return items, IndexedSequence(items, weight=lambda item: item.weight)
+
+
+def test_order_and_positions():
+    items, seq = make(range(10))
+
+    assert list(seq) == items
+    assert len(seq) == 10
+    assert seq[0] is items[0] and seq[-1] is items[-1]
+    assert [seq.index(item) for item in items] == list(range(10))
+
+
+def test_weights():
+    items, seq = make([5, 1, 3, 7])
+
+    assert seq.total() == 16
+    assert [seq.weight_before(i) for i in range(6)] == [0, 5, 6, 9, 16, 16]
+
+    items[1].weight = 11
+    seq.reweigh(items[1])
+    assert seq.total() == 26
+    assert seq.weight_before(2) == 16
+
+
+def test_deque_operations():
+    items, seq = make(range(3))
+    first, last = Item(-1), Item(9)
+
+    seq.appendleft(first)
+    seq.append(last)
+    assert list(seq) == [first] + items + [last]
+
+    assert seq.popleft() is first
+    assert seq.pop() is last
+    assert list(seq) == items
+
+
+def test_insert_and_delete():
+    items, seq = make(range(5))
+    new = Item(99)
+
+    seq.insert(2, new)
+    assert list(seq) == items[:2] + [new] + items[2:]
+
+    del seq[2]
+    assert list(seq) == items
+
+    seq.insert(100, new)
+    assert seq[-1] is new
+
+    seq.remove(items[0])
+    assert items[0] not in seq
+    assert seq.index(items[1]) == 0
+
+
+def test_errors():
+    items, seq = make(range(3))
+
+    with pytest.raises(ValueError):
+        seq.append(items[0])
+
+    with pytest.raises(ValueError):
+        seq.extend([Item(1), items[1]])
+    assert len(seq) == 3
+
+    with pytest.raises(ValueError):
+        seq.index(Item(1))
+
+    with pytest.raises(IndexError):
+        seq[3]
+
+    seq.clear()
+    assert not seq
+
+    with pytest.raises(IndexError):
+        seq.pop()
+
+    with pytest.raises(IndexError):
+        seq.popleft()
+
+
+def test_against_a_list():
+    rng = random.Random(1)
+    items, seq = make([])
+    expected = []
+
+    for _ in range(3000):
+        op = rng.random()
+
+        if op < 0.3 or not expected:
+            item = Item(rng.randint(0, 100))
+            position = rng.randint(0, len(expected))
+            seq.insert(position, item)
+            expected.insert(position, item)
+
+        elif op < 0.45:
+            batch = [Item(rng.randint(0, 100)) for _ in range(rng.randint(0, 5))]
+            seq.extend(batch)
+            expected.extend(batch)
+
+        elif op < 0.6:
+            item = rng.choice(expected)
+            seq.remove(item)
+            expected.remove(item)
+
+        elif op < 0.7:
+            assert seq.popleft() is expected.pop(0)
+
+        elif op < 0.8:
+            assert seq.pop() is expected.pop()
+
+        else:
+            item = rng.choice(expected)
+            item.weight = rng.randint(0, 100)
+            seq.reweigh(item)
+
+        assert len(seq) == len(expected)
+
+        if expected:
+            position = rng.randint(0, len(expected))
+            assert seq.weight_before(position) == sum(item.weight for item in expected[:position])
+
+            item = rng.choice(expected)
+            assert seq.index(item) == expected.index(item)
+
+    assert list(seq) == expected
+    assert seq.total() == sum(item.weight for item in expected)
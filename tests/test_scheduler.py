@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+from musicbot.exceptions import DownloadPreempted
+from musicbot.scheduler import DownloadPriority, DownloadScheduler
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def run(loop, scheduler):
+    async def wait():
+        while scheduler.running or any(scheduler.queue_depth().values()):
+            await asyncio.sleep(0.001)
+
+    loop.run_until_complete(asyncio.wait_for(wait(), 5))
+
+
+def job(log, name, *, delay=0.01, preemptible=False):
+    async def func(cancel):
+        log.append(('start', name))
+
+        for _ in range(10):
+            await asyncio.sleep(delay / 10)
+
+            if preemptible and cancel.is_set():
+                log.append(('preempted', name))
+                raise DownloadPreempted(name)
+
+        log.append(('done', name))
+
+    return func
+
+
+def test_runs_in_priority_order(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=1)
+
+    scheduler.submit('busy', job(log, 'busy'), DownloadPriority.PREFETCH)
+    scheduler.submit('low', job(log, 'low'), DownloadPriority.AUTOPLAYLIST)
+    scheduler.submit('high', job(log, 'high'), DownloadPriority.NEXT_UP)
+    run(loop, scheduler)
+
+    assert [name for event, name in log if event == 'start'] == ['busy', 'high', 'low']
+    assert scheduler.completed == 3
+
+
+def test_limits_concurrency(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=2)
+
+    for n in range(5):
+        scheduler.submit(n, job(log, n))
+
+    assert scheduler.running == 2
+    assert scheduler.queue_depth()[DownloadPriority.NEXT_UP] == 3
+
+    run(loop, scheduler)
+    assert scheduler.completed == 5
+
+
+def test_duplicate_submit_bumps_priority(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=1)
+
+    scheduler.submit('busy', job(log, 'busy'))
+    scheduler.submit('a', job(log, 'a'), DownloadPriority.PREFETCH)
+    scheduler.submit('b', job(log, 'b'), DownloadPriority.PREFETCH)
+    scheduler.submit('b', job(log, 'other'), DownloadPriority.NEXT_UP)
+    run(loop, scheduler)
+
+    assert [name for event, name in log if event == 'start'] == ['busy', 'b', 'a']
+
+
+def test_cancel_only_drops_waiting_jobs(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=1)
+
+    scheduler.submit('busy', job(log, 'busy'))
+    scheduler.submit('waiting', job(log, 'waiting'))
+
+    assert not scheduler.cancel('busy')
+    assert scheduler.cancel('waiting')
+    assert not scheduler.cancel('unknown')
+
+    run(loop, scheduler)
+    assert log == [('start', 'busy'), ('done', 'busy')]
+
+
+def test_preempts_less_important_job(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=1)
+
+    scheduler.submit('prefetch', job(log, 'prefetch', delay=0.2, preemptible=True), DownloadPriority.PREFETCH)
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+    scheduler.submit('playing', job(log, 'playing'), DownloadPriority.PLAYING)
+    run(loop, scheduler)
+
+    assert log[:4] == [('start', 'prefetch'), ('preempted', 'prefetch'), ('start', 'playing'), ('done', 'playing')]
+    assert log[-1] == ('done', 'prefetch')
+    assert scheduler.preempted == 1
+    assert scheduler.completed == 2
+
+
+def test_same_key_shares_a_job(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=2)
+
+    scheduler.submit('song', job(log, 'first'), owner='a')
+    scheduler.submit('song', job(log, 'second'), owner='b')
+    scheduler.submit('song', job(log, 'third'), owner='c')
+    assert scheduler.running == 1
+
+    assert scheduler.cancel('song', owner='c') is False  # the job is already running
+
+    loop.run_until_complete(asyncio.sleep(0))
+    scheduler.submit('song', job(log, 'late'), owner='d')
+    run(loop, scheduler)
+
+    assert [name for event, name in log if event == 'start'] == ['first', 'second', 'third', 'late']
+    assert scheduler.completed == 1
+
+
+def test_cancel_one_owner(loop):
+    log = []
+    scheduler = DownloadScheduler(loop, max_concurrent=1)
+
+    scheduler.submit('busy', job(log, 'busy'))
+    scheduler.submit('song', job(log, 'a'), owner='a')
+    scheduler.submit('song', job(log, 'b'), owner='b')
+
+    assert scheduler.cancel('song', owner='a')
+    assert not scheduler.cancel('song', owner='a')
+
+    run(loop, scheduler)
+    assert [name for event, name in log if event == 'start'] == ['busy', 'b']
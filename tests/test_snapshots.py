@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import pytest
+
+from musicbot.entry import URLPlaylistEntry, LazyPlaylistEntry
+from musicbot.fs import FileSystem
+from musicbot.snapshots import QueueSnapshots
+
+
+class Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakePlaylist:
+    def __init__(self, bot):
+        self.bot = bot
+        self.downloader = bot.downloader
+        self.entries = []
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def restore(self, entries):
+        self.entries.extend(entries)
+
+
+class FakePlayer:
+    def __init__(self, bot):
+        self.playlist = FakePlaylist(bot)
+        self.current_entry = None
+        self.position = 0
+        self.is_stopped = True
+        self.resumed = None
+        self.played = False
+
+    def resume_at(self, entry, position):
+        self.resumed = (entry, position)
+
+    def play(self):
+        self.played = True
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.downloader = Obj(fs=FileSystem(loop), download_folder='audio_cache')
+        self.players = {}
+        self.the_voice_clients = {}
+
+        server = Obj(id='s', get_member=lambda member_id: Obj(id=member_id))
+        self.channels = {'text': Obj(id='text', server=server), 'voice': Obj(id='voice', server=server)}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def get_player(self, channel, create=False):
+        player = self.players['s'] = FakePlayer(self)
+        self.the_voice_clients['s'] = Obj(channel=channel)
+        return player
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_round_trip(loop, tmp_path):
+    path = str(tmp_path / 'queues.json')
+
+    bot = FakeBot(loop)
+    player = loop.run_until_complete(bot.get_player(bot.channels['voice']))
+    text = bot.channels['text']
+
+    player.current_entry = URLPlaylistEntry(
+        player.playlist, 'http://x/0', 'Zero', 100, 'audio_cache/x-0.m4a', channel=text, author=Obj(id='a1'))
+    player.position = 42.123
+    player.playlist.entries = [
+        URLPlaylistEntry(player.playlist, 'http://x/1', 'One', 101, 'audio_cache/x-1.m4a'),
+        LazyPlaylistEntry(player.playlist, 'http://x/2', 'Two', channel=text, author=Obj(id='a2'), max_duration=300)
+    ]
+
+    snapshots = QueueSnapshots(bot, path)
+    loop.run_until_complete(snapshots.save())
+    assert snapshots.saved == 0  # nothing is saved before the last snapshot was restored
+
+    snapshots._ready = True
+    loop.run_until_complete(snapshots.save())
+    loop.run_until_complete(snapshots.save())
+    assert snapshots.saved == 1  # nothing changed the second time
+
+    restored_bot = FakeBot(loop)
+    restored = QueueSnapshots(restored_bot, path)
+    loop.run_until_complete(restored.restore())
+
+    player = restored_bot.players['s']
+    current, first, second = player.playlist.entries
+
+    assert restored.restored == 3
+    assert player.resumed == (current, 42.12)
+    assert player.played
+
+    assert type(current) is URLPlaylistEntry
+    assert (current.url, current.title, current.duration, current.expected_filename) == \
+        ('http://x/0', 'Zero', 100, 'audio_cache/x-0.m4a')
+    assert (current.channel_id, current.author_id) == ('text', 'a1')
+    assert first.author_id is None
+
+    assert type(second) is LazyPlaylistEntry
+    assert not second.resolved
+    assert second.max_duration == 300
+    assert second.meta['author'].id == 'a2'
+
+
+def test_restore_old_snapshot_without_max_duration(loop, tmp_path):
+    path = tmp_path / 'queues.json'
+    path.write_text(json.dumps({
+        'fields': ['url', 'title', 'duration', 'expected_filename', 'channel', 'author'],
+        'servers': {'s': {'voice_channel': 'voice', 'current': None, 'position': 0,
+                          'entries': [['http://x/1', 'One', 0, None, None, None]]}}
+    }))
+
+    bot = FakeBot(loop)
+    snapshots = QueueSnapshots(bot, str(path))
+    loop.run_until_complete(snapshots.restore())
+
+    entry, = bot.players['s'].playlist.entries
+    assert type(entry) is LazyPlaylistEntry
+    assert entry.max_duration == 0
+    assert bot.players['s'].resumed is None
+
+
+def test_missing_snapshot(loop, tmp_path):
+    bot = FakeBot(loop)
+    snapshots = QueueSnapshots(bot, str(tmp_path / 'queues.json'))
+    loop.run_until_complete(snapshots.restore())
+
+    assert snapshots.restored == 0
+    assert not bot.players
+
+
+def test_shutdown_snapshot_is_kept(loop, tmp_path):
+    # ;restart disconnects everything and logout() does it again, the second save mustn't wipe the queues.
+    path = str(tmp_path / 'queues.json')
+
+    bot = FakeBot(loop)
+    player = loop.run_until_complete(bot.get_player(bot.channels['voice']))
+    player.playlist.entries = [URLPlaylistEntry(player.playlist, 'http://x/1', 'One', 101, 'audio_cache/x-1.m4a')]
+
+    snapshots = QueueSnapshots(bot, path)
+    snapshots._ready = True
+    loop.run_until_complete(snapshots.save(final=True))
+
+    bot.players.clear()
+    bot.the_voice_clients.clear()
+    loop.run_until_complete(snapshots.save(final=True))
+    loop.run_until_complete(snapshots.save())
+
+    with open(path) as f:
+        assert list(json.load(f)['servers']) == ['s']
+    assert snapshots.saved == 1